@@ -8,8 +8,32 @@ import os
 import unittest
 from flask import Flask, request, abort, jsonify
 from flask_cors import CORS
-from models import Actor, Movie, setup_db
+from models import (
+    Actor, Movie, add_to_cast, db, delete_many, existing_ids, insert_many,
+    pool_status, remove_from_cast, setup_db, update_many, update_one
+)
 from auth import *
+from bulk import read_changes, read_ids, read_items, validate_items
+from caching import (
+    cache_stats, conditional, get_if_match_versions, init_cache
+)
+from compression import init_compression
+from filters import apply_filters
+from idempotency import idempotency_stats, idempotent, init_idempotency
+from metrics import init_metrics, render_metrics
+from profiler import (
+    init_profiler, list_profiles, not_profiled, read_profile
+)
+from pagination import (
+    get_limit_arg, get_page_args, get_sort_arg, paginate, sort_query
+)
+from projection import (
+    checks_includes, get_fields_arg, get_include_arg, load_includes,
+    row_formatter, select_fields
+)
+from search import get_search_terms, init_search, search
+from serialization import init_serializer, json_response
+from streaming import stream_query, wants_stream
 
 # ---------------------------------------------------------
 # Config
@@ -18,9 +42,34 @@ from auth import *
 
 def create_app(test_config=None):
     # create and configure the app
+    # `test_config` overrides config.py, e.g. with the
+    # SQLALCHEMY_DATABASE_URI and SQLALCHEMY_ENGINE_OPTIONS of the tests.
     app = Flask(__name__)
     app.url_map.strict_slashes = False
+    app.config.from_object('config')
+    if test_config is not None:
+        app.config.update(test_config)
     setup_db(app)
+    if app.config['METRICS_ENABLED']:
+        init_metrics(app, {
+            'token_cache': token_cache.stats,
+            'response_cache': cache_stats,
+            'db_pool': pool_status,
+            'idempotency': idempotency_stats
+        })
+    init_profiler(app)
+    init_cache(app)
+    init_idempotency(app)
+    init_search(app)
+    init_serializer(app)
+    init_compression(app)
+
+    # Creates the tables of an empty database, e.g. for local runs.
+    # Deployed databases are managed with: python manage.py db upgrade
+    @app.cli.command('create-db')
+    def create_db():
+        db.create_all()
+        click.echo('Created the database tables.')
 
     # CORS app
     cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -45,53 +94,187 @@ def create_app(test_config=None):
     def get_greeting():
         greeting = "Welcome to Agency! You can get JWT here." 
         return greeting
+
+    # GET endpoint for the metrics of this process, for Prometheus.
+    if app.config['METRICS_ENABLED']:
+        @app.route('/metrics', methods=['GET'])
+        @not_profiled
+        @requires_auth('get:metrics')
+        def get_metrics():
+            return app.response_class(
+                render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    # GET endpoints for the request profiles kept on disk, when the
+    # profiler is on.
+    if app.extensions['profiler'] is not None:
+        # The request profiles, newest first.
+        @app.route('/debug/profiles', methods=['GET'])
+        @not_profiled
+        @requires_auth('get:profiles')
+        def get_profiles():
+            return jsonify({
+                'success': True,
+                'profiles': list_profiles()
+            }), 200
+
+        # One request profile: its sampled stacks and SQL.
+        @app.route('/debug/profiles/<profile_id>', methods=['GET'])
+        @not_profiled
+        @requires_auth('get:profiles')
+        def get_profile(profile_id):
+            profile = read_profile(profile_id)
+            if profile is None:
+                abort(404)
+
+            return jsonify({
+                'success': True,
+                'profile': profile
+            }), 200
     
     # GET endpoint for list of actors in database.
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @checks_includes(Actor)
+    @conditional('actors')
     def get_actors():
-        actors = Actor.query.all()
+        fields = get_fields_arg(Actor)
+        includes = get_include_arg(Actor)
+        sort = get_sort_arg(Actor)
+        query = apply_filters(Actor, select_fields(Actor, fields, sort[:1]))
+
+        if wants_stream():
+            if includes:
+                abort(422)
+            return stream_query(
+                sort_query(query, Actor, sort), 'actors',
+                row_formatter(query, fields))
+
+        limit, cursor = get_page_args()
+        actors, next_cursor = paginate(query, Actor, limit, cursor, sort)
 
         if not actors:
             abort(404)
+        format_row = row_formatter(
+            query, fields, load_includes(Actor, actors, includes))
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'actors': [actor.format() for actor in actors]
+            'actors': [format_row(actor) for actor in actors],
+            'next_cursor': next_cursor
         }), 200
 
     # GET endpoint for list of movies in database.
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @checks_includes(Movie)
+    @conditional('movies')
     def get_movies():
-        movies = Movie.query.all()
+        fields = get_fields_arg(Movie)
+        includes = get_include_arg(Movie)
+        sort = get_sort_arg(Movie)
+        query = apply_filters(Movie, select_fields(Movie, fields, sort[:1]))
+
+        if wants_stream():
+            if includes:
+                abort(422)
+            return stream_query(
+                sort_query(query, Movie, sort), 'movies',
+                row_formatter(query, fields))
+
+        limit, cursor = get_page_args()
+        movies, next_cursor = paginate(query, Movie, limit, cursor, sort)
 
         if not movies:
             abort(404)
+        format_row = row_formatter(
+            query, fields, load_includes(Movie, movies, includes))
 
-        return jsonify({
+        return json_response({
+            'success': True,
+            'movies': [format_row(movie) for movie in movies],
+            'next_cursor': next_cursor
+        }), 200
+
+    # GET endpoint for a single actor in database.
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @checks_includes(Actor)
+    @conditional('actors')
+    def get_actor(actor_id):
+        fields = get_fields_arg(Actor)
+        includes = get_include_arg(Actor)
+        query = select_fields(Actor, fields, ('version',)).filter(
+            Actor.id == actor_id)
+        actor = query.one_or_none()
+
+        if not actor:
+            abort(404)
+        format_row = row_formatter(
+            query, fields, load_includes(Actor, [actor], includes))
+
+        response = json_response({
+            'success': True,
+            'actor': format_row(actor)
+        })
+        if not includes:
+            response.set_etag(str(actor.version))
+        return response, 200
+
+    # GET endpoint for a single movie in database.
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @checks_includes(Movie)
+    @conditional('movies')
+    def get_movie(movie_id):
+        fields = get_fields_arg(Movie)
+        includes = get_include_arg(Movie)
+        query = select_fields(Movie, fields, ('version',)).filter(
+            Movie.id == movie_id)
+        movie = query.one_or_none()
+
+        if not movie:
+            abort(404)
+        format_row = row_formatter(
+            query, fields, load_includes(Movie, [movie], includes))
+
+        response = json_response({
+            'success': True,
+            'movie': format_row(movie)
+        })
+        if not includes:
+            response.set_etag(str(movie.version))
+        return response, 200
+
+    # GET endpoint for actors and movies matching the words of "q", the
+    # last one also as a prefix, best matches first. Results have a
+    # single page of up to "limit" rows; a cursor is rejected rather than
+    # ignored.
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies')
+    @conditional('actors', 'movies')
+    def search_catalog():
+        terms = get_search_terms()
+        limit = get_limit_arg()
+        if 'cursor' in request.args:
+            abort(422)
+
+        return json_response({
             'success': True,
-            'movies': [movie.format() for movie in movies]
+            'results': search(terms, limit)
         }), 200
 
     # POST endpoint to add an actor to the database.
     @app.route('/add-actor', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def add_actor():
         data = request.get_json()
 
-        if 'name' not in data:
-            abort(422)
-        if 'age' not in data:
-            abort(422)
-        if 'gender' not in data:
+        values, invalid = Actor.clean(data)
+        if invalid or len(values) < len(Actor.REQUIRED_FIELDS):
             abort(422)
 
-        actor = Actor(
-            name=data['name'],
-            age=data['age'],
-            gender=data['gender']
-        )
+        actor = Actor(**values)
         actor.insert()
 
         return jsonify({
@@ -102,15 +285,15 @@ def create_app(test_config=None):
     # POST endpoint to add a movie to the database.
     @app.route('/add-movie', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def add_movie():
         data = request.get_json()
 
-        if 'title' not in data:
-            abort(422)
-        if 'release' not in data:
+        values, invalid = Movie.clean(data)
+        if invalid or len(values) < len(Movie.REQUIRED_FIELDS):
             abort(422)
 
-        movie = Movie(title=data['title'], release=data['release'])
+        movie = Movie(**values)
         movie.insert()
 
         return jsonify({
@@ -118,64 +301,119 @@ def create_app(test_config=None):
             'movie': movie.format()
         }), 200
 
+    # POST endpoint to add many actors to the database at once.
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @idempotent
+    def add_actors():
+        return bulk_create(Actor, 'actor_ids')
+
+    # POST endpoint to add many movies to the database at once.
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @idempotent
+    def add_movies():
+        return bulk_create(Movie, 'movie_ids')
+
+    # Validates a whole batch, then inserts it in a single transaction.
+    def bulk_create(model, key):
+        rows, errors = validate_items(model, read_items())
+
+        if errors:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'Request could not be processed.',
+                'errors': errors
+            }), 422
+
+        ids = insert_many(model, rows, app.config['BULK_CHUNK_SIZE'])
+
+        return jsonify({
+            'success': True,
+            key: ids
+        }), 200
+
     # PATCH endpoint to update an actor in the database.
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actor')
+    @idempotent
     def update_actor(actor_id):
         if not actor_id:
             abort(404)
 
-        actor = Actor.query.get(actor_id)
-        if not actor:
-            abort(404)
-
         data = request.get_json()
 
-        if 'name' in data and data['name']:
-            actor.name = data['name']
-
-        if 'age' in data and data['age']:
-            actor.age = data['age']
-
-        if 'gender' in data and data['gender']:
-            actor.gender = data['gender']
-
-        actor.update()
+        values, invalid = Actor.clean(data)
+        if invalid:
+            abort(422)
 
-        return jsonify({
-            'success': True,
-            'actor': actor.format(),
-        }), 200
+        return update_item(Actor, actor_id, values, 'actor')
 
     # PATCH endpoint to update a movie in the database.
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movie')
+    @idempotent
     def update_movie(movie_id):
         if not movie_id:
             abort(404)
 
-        movie = Movie.query.get(movie_id)
-        if not movie:
-            abort(404)
-
         data = request.get_json()
 
-        if 'title' in data and data['title']:
-            movie.title = data['title']
+        values, invalid = Movie.clean(data)
+        if invalid:
+            abort(422)
+
+        return update_item(Movie, movie_id, values, 'movie')
+
+    # Applies `values` to one row with a single conditional UPDATE, without
+    # reading the row first. With If-Match, the row is only updated while
+    # its version, the ETag of its responses, still matches; otherwise
+    # nothing is written and the request fails with 412.
+    def update_item(model, row_id, values, key):
+        versions = get_if_match_versions()
+        row = update_one(model, row_id, values, versions)
+        if row is None:
+            if versions is None or not existing_ids(model, [row_id]):
+                abort(404)
+            abort(412)
+
+        response = jsonify({
+            'success': True,
+            key: row
+        })
+        response.set_etag(str(row['version']))
+        return response, 200
 
-        if 'release' in data and data['release']:
-            movie.release = data['release']
+    # PATCH endpoint to update many actors in one transaction.
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actor')
+    @idempotent
+    def update_actors():
+        return bulk_update(Actor, 'actor_ids')
+
+    # PATCH endpoint to update many movies in one transaction.
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    @idempotent
+    def update_movies():
+        return bulk_update(Movie, 'movie_ids')
 
-        movie.update()
+    # Applies set-based updates and reports which ids matched.
+    def bulk_update(model, key):
+        changes = read_changes(model)
+        matched = update_many(model, changes, app.config['BULK_CHUNK_SIZE'])
 
         return jsonify({
             'success': True,
-            'movie': movie.format(),
+            key: matched,
+            'not_found': sorted(set(changes) - set(matched))
         }), 200
 
     # DELETE endpoint to delete actors in the database.
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actor')
+    @idempotent
     def delete_actor(actor_id):
         if not actor_id:
             abort(404)
@@ -194,6 +432,7 @@ def create_app(test_config=None):
     # DELETE endpoint to delete movies in the database.
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movie')
+    @idempotent
     def delete_movie(movie_id):
         if not movie_id:
             abort(404)
@@ -209,6 +448,73 @@ def create_app(test_config=None):
             'movie_id': movie_id
         }), 200
 
+    # POST endpoint to add actors to the cast of a movie.
+    # Takes {"actor_ids": [...]}; actors already cast stay in the cast.
+    @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
+    @requires_auth('patch:movie')
+    @idempotent
+    def add_cast(movie_id):
+        if not existing_ids(Movie, [movie_id]):
+            abort(404)
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(422)
+
+        actor_ids = read_ids(data.get('actor_ids'))
+        found = add_to_cast(movie_id, actor_ids, app.config['BULK_CHUNK_SIZE'])
+
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'actor_ids': found,
+            'not_found': sorted(set(actor_ids) - set(found))
+        }), 200
+
+    # DELETE endpoint to remove an actor from the cast of a movie.
+    @app.route('/movies/<int:movie_id>/cast/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth('patch:movie')
+    @idempotent
+    def delete_cast(movie_id, actor_id):
+        if not remove_from_cast(movie_id, actor_id):
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'actor_id': actor_id
+        }), 200
+
+    # DELETE endpoint to delete many actors in one transaction.
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    @idempotent
+    def delete_actors():
+        return bulk_delete(Actor, 'actor_ids')
+
+    # DELETE endpoint to delete many movies in one transaction.
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    @idempotent
+    def delete_movies():
+        return bulk_delete(Movie, 'movie_ids')
+
+    # Deletes rows by id and reports which ids matched.
+    def bulk_delete(model, key):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(422)
+
+        ids = read_ids(data.get('ids'))
+        matched = delete_many(model, ids, app.config['BULK_CHUNK_SIZE'])
+
+        return jsonify({
+            'success': True,
+            key: matched,
+            'not_found': sorted(set(ids) - set(matched))
+        }), 200
+
 # ---------------------------------------------------------
 # Error Handling
 # ---------------------------------------------------------
@@ -236,6 +542,22 @@ def create_app(test_config=None):
             "message": "Item not found."
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "Request is already in progress."
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "Resource was modified by another request."
+        }), 412
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
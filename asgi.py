@@ -0,0 +1,220 @@
+# ---------------------------------------------------------
+# ASGI entry point
+#
+# Serves the Flask app from an asyncio event loop, e.g. with
+#   uvicorn asgi:app
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+#
+# The event loop reads request bodies and writes responses, so slow
+# clients only hold a coroutine. The Flask app itself runs on a bounded
+# pool of ASGI_THREADS threads, since Flask 1.1 views, Flask-SQLAlchemy
+# 2.5 and SQLAlchemy 1.3 are synchronous. Routes, requires_auth and the
+# error handlers are the ones of app.py.
+#
+# uvicorn.middleware.wsgi.WSGIMiddleware is not used: it queues every
+# chunk of a response without limit, so a streamed export to a slow
+# client ends up whole in memory, and it keeps running the app after the
+# client disconnected. Here a worker stays at most MAX_PENDING_CHUNKS
+# ahead of the client and stops on disconnect. It has no lifespan
+# support either, needed to load the JWKS at startup.
+# ---------------------------------------------------------
+
+import asyncio
+import logging
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app import app as flask_app
+from auth import jwks_cache
+
+logger = logging.getLogger(__name__)
+
+# Request bodies larger than this are spooled to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+# Response chunks a worker thread may produce ahead of the client.
+MAX_PENDING_CHUNKS = 4
+
+
+# Builds the WSGI environ of an ASGI HTTP `scope` (PEP 3333).
+# Returns: dictionary
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode(
+            'utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+# Reads the whole request body from the client.
+# Returns: file object positioned at the start
+async def read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.write(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body
+
+
+# ASGI application running a WSGI `wsgi_app` on `threads` threads.
+class ASGIAdapter:
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope: {scope["type"]!r}')
+
+    # Fetches the JWKS on startup, off the event loop, so the first
+    # authenticated requests do not wait for Auth0.
+    async def lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                loaded = await loop.run_in_executor(
+                    self.executor, jwks_cache.refresh)
+                if not loaded and not jwks_cache.is_loaded():
+                    logger.warning('JWKS not available at startup')
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await loop.run_in_executor(None, self.executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        environ = build_environ(scope, await read_body(receive))
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        # Keeps a streaming response from running far ahead of the client.
+        pending = threading.Semaphore(MAX_PENDING_CHUNKS)
+        disconnected = threading.Event()
+
+        def post(message):
+            if not disconnected.is_set():
+                pending.acquire()
+            if disconnected.is_set():
+                raise ConnectionError('client disconnected')
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        # The server only reports a disconnect through receive(); send()
+        # keeps returning after it, e.g. with uvicorn.
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+            pending.release()
+
+        def run():
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response['status'] = int(status.split(' ', 1)[0])
+                response['headers'] = [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers]
+
+            result = self.wsgi_app(environ, start_response)
+            try:
+                started = False
+                for chunk in result:
+                    if not chunk:
+                        continue
+                    if not started:
+                        post(('start', response))
+                        started = True
+                    post(('body', chunk))
+                if not started:
+                    post(('start', response))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+                environ['wsgi.input'].close()
+
+        future = loop.run_in_executor(self.executor, run)
+        future.add_done_callback(
+            lambda _: messages.put_nowait(('end', None)))
+        watcher = loop.create_task(watch_disconnect())
+
+        try:
+            while True:
+                kind, value = await messages.get()
+                if kind == 'end' or disconnected.is_set():
+                    break
+                pending.release()
+                if kind == 'start':
+                    await send({'type': 'http.response.start',
+                                'status': value['status'],
+                                'headers': value['headers']})
+                else:
+                    await send({'type': 'http.response.body',
+                                'body': value, 'more_body': True})
+        except BaseException:
+            disconnected.set()
+            pending.release()
+            raise
+        finally:
+            watcher.cancel()
+
+        if disconnected.is_set():
+            # The worker stops at its next chunk; nobody is left to answer.
+            await asyncio.wait([future])
+            error = future.exception()
+            if error and not isinstance(error, ConnectionError):
+                logger.error('Request failed after the client disconnected',
+                             exc_info=error)
+            return
+
+        # Raises the exception of the app, if any, after its response.
+        await future
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+# Creates the ASGI application of a Flask `flask_app`. The thread pool
+# defaults to the size of the database pool plus its overflow, the most
+# requests that can use a connection at once.
+def create_asgi_app(flask_app):
+    config = flask_app.config
+    threads = config.get('ASGI_THREADS') or \
+        config.get('DB_POOL_SIZE', 5) + config.get('DB_MAX_OVERFLOW', 10)
+    return ASGIAdapter(flask_app, threads)
+
+
+app = create_asgi_app(flask_app)
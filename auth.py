@@ -1,8 +1,15 @@
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from metrics import record_phase
 
 # ---------------------------------------------------------
 # Utils
@@ -11,20 +18,220 @@ from urllib.request import urlopen
 AUTH0_DOMAIN = 'tomascap.jp.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'agency'
-JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# Seconds a fetched key set is served before it is refreshed.
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+# Minimum seconds between two fetches of the key set.
+JWKS_MIN_REFETCH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_TIMEOUT = int(os.environ.get('JWKS_TIMEOUT', 5))
+
+# Maximum number of verified tokens kept in memory.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# Seconds of clock skew allowed when checking "exp".
+JWT_LEEWAY = int(os.environ.get('JWT_LEEWAY', 10))
+
+
+logger = logging.getLogger(__name__)
+
+# Modes of requires_auth() when several permissions are given.
+ALL_OF = 'all'
+ANY_OF = 'any'
 
 
 # Gets JSON data from URL
+# Also accepts file:// URLs, which have no HTTP status code.
 # Source: https://bit.ly/3cbBd5y
 def get_json_data(url):
-    operUrl = urlopen(url)
-    if(operUrl.getcode() != 200):
+    operUrl = urlopen(url, timeout=JWKS_TIMEOUT)
+    if(operUrl.getcode() not in (None, 200)):
         return False
 
     data = operUrl.read()
     jsonData = json.loads(data)
     return jsonData
 
+# ---------------------------------------------------------
+# JSON Web Key Set cache
+# ---------------------------------------------------------
+
+
+# Thread-safe store of the JSON web keys, keyed by "kid".
+# A fetched key set is served from memory for `ttl` seconds. Once it is
+# stale it is still served while a background thread refetches it. An
+# unknown "kid" triggers a synchronous refetch, but fetches never happen
+# more often than once every `min_refetch_interval` seconds.
+# Readers never take a lock: `_keys` is replaced, never mutated.
+class JWKSCache:
+    def __init__(self, url, ttl=JWKS_TTL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self._fetch = fetch or get_json_data
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._fetch_lock = threading.Lock()
+        self._refreshing = threading.Event()
+
+    # Returns the key dictionary for `kid`, or None if it is unknown.
+    def get(self, kid):
+        if self._fetched_at is None:
+            if self._may_refetch():
+                self.refresh()
+        elif time.monotonic() - self._fetched_at >= self.ttl:
+            self.refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._fetched_at is not None \
+                and self._may_refetch():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    # True once at least one key set has been fetched.
+    def is_loaded(self):
+        return self._fetched_at is not None
+
+    def _may_refetch(self):
+        return self._attempted_at is None or \
+            time.monotonic() - self._attempted_at >= \
+            self.min_refetch_interval
+
+    # Fetches the key set now. Keeps the previous keys on failure.
+    # Returns: True if a new key set was stored.
+    def refresh(self):
+        requested_at = time.monotonic()
+        with self._fetch_lock:
+            # Another thread fetched while this one waited for the lock.
+            if self._attempted_at is not None and \
+                    self._attempted_at >= requested_at:
+                return False
+            self._attempted_at = time.monotonic()
+
+            try:
+                jwks_data = self._fetch(self.url)
+            except (OSError, ValueError):
+                jwks_data = None
+            record_phase('jwks_fetch', time.monotonic() - self._attempted_at)
+
+            if not jwks_data or 'keys' not in jwks_data:
+                return False
+
+            self._keys = {
+                key['kid']: {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use'),
+                    'n': key['n'],
+                    'e': key['e']
+                }
+                for key in jwks_data['keys'] if 'kid' in key
+            }
+            self._fetched_at = time.monotonic()
+            return True
+
+    # Starts a refresh on a daemon thread unless one is running.
+    def refresh_in_background(self):
+        if self._refreshing.is_set() or not self._may_refetch():
+            return
+        self._refreshing.set()
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing.clear()
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+# ---------------------------------------------------------
+# Verified token cache
+# ---------------------------------------------------------
+
+
+# Decoded payload of a verified token, with its permissions compiled
+# once into a frozenset (None when the payload has no permissions claim).
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions'])
+
+
+# Builds the VerifiedToken of a decoded payload.
+# Accepts: payload (dictionary)
+# Returns: verified token (VerifiedToken)
+def compile_payload(payload):
+    permissions = payload.get('permissions')
+    if not isinstance(permissions, (list, tuple, set, frozenset)):
+        return VerifiedToken(payload, None)
+    return VerifiedToken(payload, frozenset(permissions))
+
+
+# Bounded LRU cache of verified tokens.
+# Entries are keyed by a SHA-256 hash of the token, so raw tokens are
+# never kept in memory, and are dropped once the token's "exp" plus the
+# allowed clock skew has passed. Tokens without "exp" are never cached.
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, leeway=JWT_LEEWAY):
+        self.maxsize = maxsize
+        self.leeway = leeway
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    # Returns the cached VerifiedToken for `token`, or None.
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                verified, expires_at = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return verified
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, verified):
+        exp = verified.payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.maxsize <= 0:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (verified, exp + self.leeway)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # Returns: dictionary with size, hits and misses.
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+token_cache = TokenCache()
+
 # ---------------------------------------------------------
 # Authorization
 # ---------------------------------------------------------
@@ -72,18 +279,39 @@ def get_token_auth_header():
     return split_auth_header[1]
 
 
-# Checks permission against the payload coming from Auth0.
+# Checks permissions against the payload coming from Auth0.
 # For more: verify_decode_jwt()
-# Accepts: permission (string) and payload (dictionary).
-def check_permissions(permission, payload):
-    print(payload)
-    if 'permissions' not in payload:
+# Accepts: permission (string or set of strings), payload (dictionary or
+# VerifiedToken) and match (ALL_OF or ANY_OF).
+def check_permissions(permission, payload, match=ALL_OF):
+    if isinstance(payload, VerifiedToken):
+        verified = payload
+    else:
+        verified = compile_payload(payload)
+
+    if verified.permissions is None:
         raise AuthError({
             'code': 'invalid_payload',
             'description': 'Invalid payload.'
         }, 422)
 
-    if permission not in payload['permissions']:
+    if isinstance(permission, str):
+        required = (permission,)
+    else:
+        required = permission
+
+    if match == ANY_OF:
+        allowed = not verified.permissions.isdisjoint(required)
+    else:
+        allowed = verified.permissions.issuperset(required)
+
+    if not allowed:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('permission denied', extra={
+                'sub': verified.payload.get('sub'),
+                'required': sorted(required),
+                'match': match
+            })
         raise AuthError({
             'code': 'forbidden',
             'description': 'Request is forbidden.'
@@ -92,19 +320,11 @@ def check_permissions(permission, payload):
     return True
 
 
-# Fetches JSON web key set from Auth0
+# Looks up the signing key in the cached JSON web key set from Auth0
 # Accepts: token (string)
 # Returns: rsa_key (dictionary)
 # Link: https://auth0.com/docs/tokens/concepts/jwks
 def get_rsa_key(token):
-    jwks_data = get_json_data(JWKS_URL)
-
-    if not jwks_data:
-        raise AuthError({
-            'code': 'invalid_auth_api',
-            'description': 'Invalid authorization API.'
-        }, 422)
-
     jwt_headers = jwt.get_unverified_headers(token)
     if 'kid' not in jwt_headers:
         raise AuthError({
@@ -112,17 +332,13 @@ def get_rsa_key(token):
             'description': 'Missing "kid" header.'
         }, 422)
 
-    rsa_key = None
-    for key in jwks_data['keys']:
-        if key['kid'] != jwt_headers['kid']:
-            continue
-        rsa_key = {
-            'kty': key['kty'],
-            'kid': key['kid'],
-            'use': key['use'],
-            'n': key['n'],
-            'e': key['e']
-        }
+    rsa_key = jwks_cache.get(jwt_headers['kid'])
+
+    if not jwks_cache.is_loaded():
+        raise AuthError({
+            'code': 'invalid_auth_api',
+            'description': 'Invalid authorization API.'
+        }, 422)
 
     if not rsa_key:
         raise AuthError({
@@ -145,7 +361,8 @@ def verify_decode_jwt(token):
             rsa_key,
             algorithms=ALGORITHMS,
             audience=API_AUDIENCE,
-            issuer=f'https://{AUTH0_DOMAIN}/'
+            issuer=f'https://{AUTH0_DOMAIN}/',
+            options={'leeway': JWT_LEEWAY}
         )
         return payload
 
@@ -168,14 +385,48 @@ def verify_decode_jwt(token):
         }, 422)
 
 
+# Verification and decoding of JWT, skipped for tokens verified before.
+# Receives: token (string)
+# Returns: verified token (VerifiedToken)
+def get_verified_token(token):
+    verified = token_cache.get(token)
+    if verified is None:
+        started = time.perf_counter()
+        verified = compile_payload(verify_decode_jwt(token))
+        record_phase('jwt_decode', time.perf_counter() - started)
+        token_cache.put(token, verified)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('token verified', extra={
+                'sub': verified.payload.get('sub'),
+                'exp': verified.payload.get('exp'),
+                'permissions': sorted(verified.permissions or ())
+            })
+    return verified
+
+
+# Returns: the VerifiedToken of the current request, or None.
+def get_current_token():
+    return getattr(_request_ctx_stack.top, 'current_token', None)
+
+
 # Decorator to check permissions and authentication on endpoints.
-def requires_auth(permission=''):
+# With several permissions, match=ALL_OF requires every one of them and
+# match=ANY_OF requires at least one.
+def requires_auth(*permissions, match=ALL_OF):
+    if match not in (ALL_OF, ANY_OF):
+        raise ValueError(f'Unknown permission match mode: {match!r}')
+    required = frozenset(permissions)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            started = time.perf_counter()
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            record_phase('auth_header', time.perf_counter() - started)
+            verified = get_verified_token(token)
+            check_permissions(required, verified, match)
+            record_phase('auth', time.perf_counter() - started)
+            _request_ctx_stack.top.current_token = verified
             return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,434 @@
+# ---------------------------------------------------------
+# Load test and micro-benchmark of every route of the API.
+#
+# Seeds --rows actors and movies into a local database (a temporary
+# SQLite file, or --database, e.g. a local Postgres), signs tokens with a
+# local RSA key published as a JWKS file (local_jwt.py), then sends
+# --requests requests to each route through
+#   client  - the Flask test client, i.e. the app alone
+#   server  - a threaded werkzeug server over real HTTP connections,
+#             with --concurrency clients at once
+# and reports p50/p99 latency, requests per second and memory.
+# Results are saved as JSON; --compare prints the change against an
+# earlier result file.
+#
+# Usage:
+#   python benchmarks/bench_api.py --rows 10000
+#   python benchmarks/bench_api.py --database postgresql://localhost/bench \
+#       --rows 1000000 --compare benchmarks/results/<commit>.json
+# ---------------------------------------------------------
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DRIVERS = ('client', 'server')
+SEED_CHUNK_SIZE = 10000
+BULK_SIZE = 100
+GENDERS = ('female', 'male', 'non-binary', 'other')
+
+# ---------------------------------------------------------
+# Routes
+#
+# Each route maps to (method, builder, requests factor); the builder
+# takes the seeded ids and the request number and returns the path and
+# the JSON body. Rows deleted by the DELETE routes are created before
+# the timed requests, in `victims`.
+# ---------------------------------------------------------
+
+
+def actor_body(i):
+    return {'name': f'Bench actor {i}', 'age': 20 + i % 60,
+            'gender': GENDERS[i % len(GENDERS)]}
+
+
+def movie_body(i):
+    release = date(1950, 1, 1) + timedelta(days=i * 7919 % 25000)
+    return {'title': f'Bench movie {i}', 'release': release.isoformat()}
+
+
+def pick(ids, i):
+    return ids[(i * 7919) % len(ids)]
+
+
+ROUTES = {
+    'get_greeting': ('GET', lambda ctx, i: ('/', None), 1),
+    'get_metrics': ('GET', lambda ctx, i: ('/metrics', None), 1),
+    'get_profiles': ('GET', lambda ctx, i: ('/debug/profiles', None), 1),
+    'get_actors': ('GET', lambda ctx, i: (
+        '/actors?limit=50', None), 1),
+    'get_movies': ('GET', lambda ctx, i: (
+        f'/movies?limit=50&include=cast&sort=-release'
+        f'&released_after=19{50 + i % 50}-01-01', None), 1),
+    'get_actor': ('GET', lambda ctx, i: (
+        f'/actors/{pick(ctx["actor_ids"], i)}', None), 1),
+    'get_movie': ('GET', lambda ctx, i: (
+        f'/movies/{pick(ctx["movie_ids"], i)}?include=cast', None), 1),
+    'search_catalog': ('GET', lambda ctx, i: (
+        f'/search?q=actor+{i % 1000}', None), 1),
+    'add_actor': ('POST', lambda ctx, i: ('/add-actor', actor_body(i)), 1),
+    'add_movie': ('POST', lambda ctx, i: ('/add-movie', movie_body(i)), 1),
+    'add_actors': ('POST', lambda ctx, i: (
+        '/actors/bulk', [actor_body(i * BULK_SIZE + j)
+                         for j in range(BULK_SIZE)]), 0.1),
+    'add_movies': ('POST', lambda ctx, i: (
+        '/movies/bulk', [movie_body(i * BULK_SIZE + j)
+                         for j in range(BULK_SIZE)]), 0.1),
+    'update_actor': ('PATCH', lambda ctx, i: (
+        f'/actors/{pick(ctx["actor_ids"], i)}', {'age': 20 + i % 60}), 1),
+    'update_movie': ('PATCH', lambda ctx, i: (
+        f'/movies/{pick(ctx["movie_ids"], i)}',
+        {'title': f'Bench movie {i}'}), 1),
+    'update_actors': ('PATCH', lambda ctx, i: (
+        '/actors/bulk', {'ids': [pick(ctx['actor_ids'], i * BULK_SIZE + j)
+                                 for j in range(BULK_SIZE)],
+                         'changes': {'age': 20 + i % 60}}), 0.1),
+    'update_movies': ('PATCH', lambda ctx, i: (
+        '/movies/bulk', {'ids': [pick(ctx['movie_ids'], i * BULK_SIZE + j)
+                                 for j in range(BULK_SIZE)],
+                         'changes': {'title': f'Bench movie {i}'}}), 0.1),
+    'add_cast': ('POST', lambda ctx, i: (
+        f'/movies/{pick(ctx["movie_ids"], i)}/cast',
+        {'actor_ids': [pick(ctx['actor_ids'], i)]}), 1),
+    'delete_cast': ('DELETE', lambda ctx, i: (
+        '/movies/{}/cast/{}'.format(*ctx['victims']['delete_cast'][i]),
+        None), 1),
+    'delete_actor': ('DELETE', lambda ctx, i: (
+        f'/actors/{ctx["victims"]["delete_actor"][i]}', None), 1),
+    'delete_movie': ('DELETE', lambda ctx, i: (
+        f'/movies/{ctx["victims"]["delete_movie"][i]}', None), 1),
+    'delete_actors': ('DELETE', lambda ctx, i: (
+        '/actors/bulk', {'ids': ctx['victims']['delete_actors'][
+            i * BULK_SIZE:(i + 1) * BULK_SIZE]}), 0.1),
+    'delete_movies': ('DELETE', lambda ctx, i: (
+        '/movies/bulk', {'ids': ctx['victims']['delete_movies'][
+            i * BULK_SIZE:(i + 1) * BULK_SIZE]}), 0.1),
+}
+
+# ---------------------------------------------------------
+# Setup
+# ---------------------------------------------------------
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='actors and movies to seed (default 1000)')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per route (default 100)')
+    parser.add_argument('--database',
+                        help='database URL (default: a temporary SQLite file)')
+    parser.add_argument('--drivers', default=','.join(DRIVERS),
+                        help='comma separated: client, server')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='concurrent clients of the server driver')
+    parser.add_argument('--routes', help='comma separated route names')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the response cache')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also trace the peak allocations of each route '
+                        '(slows every request several times)')
+    parser.add_argument('--output', help='result file (default '
+                        'benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='earlier result file')
+    return parser.parse_args()
+
+
+# Builds the app on the benchmark database, with auth.py trusting the
+# key of a LocalIssuer in place of Auth0's.
+# Returns: the app and the LocalIssuer signing the tokens
+def configure(args, workdir):
+    from app import create_app
+    from auth import jwks_cache
+    from local_jwt import LocalIssuer
+
+    if args.database is None:
+        args.database = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    # Metrics are on, as in a monitored deployment, and /metrics is one of
+    # the benchmarked routes.
+    config = {'DEBUG': False, 'SQLALCHEMY_DATABASE_URI': args.database,
+              'METRICS_ENABLED': True}
+    if args.no_cache:
+        config['RESPONSE_CACHE_SIZE'] = 0
+
+    issuer = LocalIssuer()
+    jwks_cache.url = issuer.write_jwks(os.path.join(workdir, 'jwks.json'))
+    return create_app(config), issuer
+
+
+# Fills the tables up to `rows` actors and movies, with three actors in
+# the cast of each seeded movie.
+# Returns: the ids of the actors and movies (dictionary)
+def seed(rows):
+    from models import (
+        Actor, Movie, chunked, commit_changes, db, insert_many, movie_cast
+    )
+
+    db.create_all()
+    for model, body in ((Actor, actor_body), (Movie, movie_body)):
+        missing = rows - model.query.count()
+        for start in range(0, max(missing, 0), SEED_CHUNK_SIZE):
+            count = min(SEED_CHUNK_SIZE, missing - start)
+            values = [model.clean(body(start + i))[0] for i in range(count)]
+            ids = insert_many(model, values, SEED_CHUNK_SIZE)
+            if model is Movie:
+                actor_ids = [row[0] for row in db.session.query(Actor.id)]
+                links = [{'movie_id': movie_id,
+                          'actor_id': pick(actor_ids, 3 * n + k)}
+                         for n, movie_id in enumerate(ids) for k in range(3)]
+                for chunk in chunked(links, SEED_CHUNK_SIZE):
+                    db.session.execute(movie_cast.insert(), chunk)
+                commit_changes('movies', 'actors')
+
+    return {
+        'actor_ids': [row[0] for row in db.session.query(Actor.id)],
+        'movie_ids': [row[0] for row in db.session.query(Movie.id)]
+    }
+
+
+# Creates the rows the DELETE routes remove during the run.
+# Returns: route name -> ids (list)
+def create_victims(ctx, count):
+    from models import Actor, Movie, add_to_cast, insert_many
+
+    bulk = count * BULK_SIZE
+    victims = {
+        'delete_actor': insert_many(
+            Actor, [Actor.clean(actor_body(i))[0] for i in range(count)]),
+        'delete_movie': insert_many(
+            Movie, [Movie.clean(movie_body(i))[0] for i in range(count)]),
+        'delete_actors': insert_many(
+            Actor, [Actor.clean(actor_body(i))[0] for i in range(bulk)]),
+        'delete_movies': insert_many(
+            Movie, [Movie.clean(movie_body(i))[0] for i in range(bulk)])
+    }
+
+    movie_id = ctx['movie_ids'][0]
+    actor_ids = insert_many(
+        Actor, [Actor.clean(actor_body(i))[0] for i in range(count)])
+    add_to_cast(movie_id, actor_ids)
+    victims['delete_cast'] = [(movie_id, actor_id) for actor_id in actor_ids]
+    return victims
+
+# ---------------------------------------------------------
+# Drivers
+# ---------------------------------------------------------
+
+
+# Sends requests with the Flask test client, one at a time.
+class ClientDriver:
+    name = 'client'
+    concurrency = 1
+
+    def __init__(self, app, headers):
+        self.client = app.test_client()
+        self.headers = headers
+
+    def request(self, method, path, body):
+        response = self.client.open(path, method=method, json=body,
+                                    headers=self.headers)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+# Sends requests over HTTP to a threaded werkzeug server.
+class ServerDriver:
+    name = 'server'
+
+    def __init__(self, app, headers, concurrency):
+        from werkzeug.serving import make_server
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.headers = dict(headers, **{'Content-Type': 'application/json'})
+        self.concurrency = concurrency
+
+    def request(self, method, path, body):
+        connection = http.client.HTTPConnection(
+            '127.0.0.1', self.server.server_port, timeout=60)
+        try:
+            connection.request(
+                method, path.replace(' ', '+'),
+                json.dumps(body) if body is not None else None,
+                self.headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+# ---------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------
+
+
+# Returns: the `fraction` percentile of sorted `values`.
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+# Returns: the peak resident set size of the process, in MiB.
+def max_rss_mib():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return usage / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# Sends the requests of `route` through `driver`.
+# Returns: result (dictionary)
+def run_route(driver, route, ctx, count, trace_memory):
+    method, build, factor = ROUTES[route]
+    count = max(1, int(count * factor))
+    requests = [build(ctx, i) for i in range(count)]
+    latencies = []
+    errors = []
+
+    def send(request):
+        started = time.perf_counter()
+        status = driver.request(method, *request)
+        latencies.append(time.perf_counter() - started)
+        if status >= 400:
+            errors.append(status)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(driver.concurrency) as executor:
+        list(executor.map(send, requests))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'driver': driver.name,
+        'route': route,
+        'method': method,
+        'requests': count,
+        'errors': len(errors),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / count * 1000,
+        'rps': count / elapsed,
+        'peak_alloc_kib': peak / 1024 if peak is not None else None
+    }
+
+
+def print_result(result, previous=None):
+    line = (f'{result["driver"]:<7} {result["route"]:<15} '
+            f'{result["p50_ms"]:8.2f} {result["p99_ms"]:8.2f} '
+            f'{result["rps"]:9.1f}')
+    if result['errors']:
+        line += f'  {result["errors"]} errors'
+    if previous:
+        change = result['p50_ms'] / previous['p50_ms'] - 1
+        line += f'  p50 {change:+.0%} vs {previous["p50_ms"]:.2f}'
+    print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp()
+    app, issuer = configure(args, workdir)
+
+    from models import db
+    from sqlalchemy.engine.url import make_url
+
+    headers = issuer.auth_header()
+
+    routes = args.routes.split(',') if args.routes else list(ROUTES)
+    endpoints = set(app.view_functions) - {'static'}
+    for endpoint in sorted(endpoints - set(ROUTES)):
+        print(f'warning: route {endpoint} is not benchmarked')
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as compare_file:
+            for result in json.load(compare_file)['results']:
+                previous[(result['driver'], result['route'])] = result
+
+    with app.app_context():
+        started = time.perf_counter()
+        ctx = seed(args.rows)
+        print(f'seeded {args.rows} rows in '
+              f'{time.perf_counter() - started:.1f} s')
+
+        results = []
+        print(f'{"driver":<7} {"route":<15} {"p50 ms":>8} {"p99 ms":>8} '
+              f'{"req/s":>9}')
+        for name in args.drivers.split(','):
+            ctx['victims'] = create_victims(ctx, args.requests)
+            db.session.remove()
+            if name == 'client':
+                driver = ClientDriver(app, headers)
+            else:
+                driver = ServerDriver(app, headers, args.concurrency)
+            try:
+                for route in routes:
+                    result = run_route(driver, route, ctx, args.requests,
+                                       args.trace_memory)
+                    print_result(result, previous.get((name, route)))
+                    results.append(result)
+            finally:
+                driver.close()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': make_url(args.database).get_backend_name(),
+        'rows': args.rows,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'response_cache': not args.no_cache,
+        'max_rss_mib': max_rss_mib(),
+        'results': results
+    }
+    print(f'max RSS {report["max_rss_mib"]:.0f} MiB')
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f'{report["commit"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f'saved {output}')
+
+
+if __name__ == '__main__':
+    main()
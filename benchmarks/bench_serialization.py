@@ -0,0 +1,104 @@
+# ---------------------------------------------------------
+# Benchmark of the JSON serialization of list responses.
+#
+# Compares, on the same row tuples of select_fields(Movie, ...):
+#   before  - format_row() by attribute + jsonify(), the path the list
+#             endpoints used before serialization.py
+#   stdlib  - row_formatter() + json_response() with the json module
+#   orjson  - row_formatter() + json_response() with orjson
+#
+# Usage: python benchmarks/bench_serialization.py [rows ...]
+# ---------------------------------------------------------
+
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + DATABASE_FILE
+sys.path.insert(0, ROOT)
+
+from flask import jsonify  # noqa: E402
+from flask.json import JSONEncoder  # noqa: E402
+from app import create_app  # noqa: E402
+from models import Movie, db, insert_many  # noqa: E402
+from projection import row_formatter, select_fields  # noqa: E402
+from serialization import (  # noqa: E402
+    SERIALIZERS, json_response, orjson
+)
+
+REPEAT = 3
+
+
+# The per-row formatting of the list endpoints before row_formatter().
+def format_row_by_attribute(row, fields):
+    return {field: getattr(row, field) for field in fields}
+
+
+def before(app, query, rows):
+    app.json_encoder = JSONEncoder
+    payload = [format_row_by_attribute(row, Movie.FIELDS) for row in rows]
+    return jsonify({'success': True, 'movies': payload}).get_data()
+
+
+def after(serializer):
+    def run(app, query, rows):
+        app.extensions['serializer'] = SERIALIZERS[serializer]
+        format_row = row_formatter(query, Movie.FIELDS)
+        payload = [format_row(row) for row in rows]
+        return json_response({'success': True, 'movies': payload}).get_data()
+    return run
+
+
+# Runs `function` REPEAT times.
+# Returns: best time (seconds) and the size of the body (bytes)
+def measure(function, *args):
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        body = function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def seed(count):
+    Movie.query.delete()
+    db.session.commit()
+    first = date(1950, 1, 1)
+    insert_many(Movie, [
+        {'title': f'Movie {i}', 'release': first + timedelta(days=i % 25000)}
+        for i in range(count)])
+
+
+def main(counts):
+    app = create_app()
+    app.config['DEBUG'] = False
+    candidates = [('before', before), ('stdlib', after('stdlib'))]
+    if orjson is not None:
+        candidates.append(('orjson', after('orjson')))
+
+    with app.app_context(), app.test_request_context():
+        db.create_all()
+        for count in counts:
+            seed(count)
+            query = select_fields(Movie, Movie.FIELDS)
+            rows = query.all()
+
+            print(f'{count} rows')
+            baseline = None
+            for name, function in candidates:
+                elapsed, size = measure(function, app, query, rows)
+                baseline = baseline or elapsed
+                print(f'  {name:<7} {elapsed * 1000:8.1f} ms '
+                      f'{count / elapsed:>12,.0f} rows/s '
+                      f'{size / 1e6:6.1f} MB  x{baseline / elapsed:.1f}')
+
+    os.remove(DATABASE_FILE)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
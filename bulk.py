@@ -0,0 +1,128 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import json
+from flask import abort, current_app, request
+
+# ---------------------------------------------------------
+# Bulk requests
+# ---------------------------------------------------------
+
+
+# Reads the items of a bulk request.
+# The body is either a JSON array or, with the application/x-ndjson
+# content type, one JSON object per line. The lines are split from
+# request.get_data(), which stays readable after idempotent() has read the
+# body to fingerprint it, unlike request.stream.
+# Aborts with 422 on a malformed body or more than BULK_MAX_ITEMS items.
+# Returns: items (list)
+def read_items():
+    max_items = current_app.config.get('BULK_MAX_ITEMS', 10000)
+
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data().splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                abort(422)
+            if len(items) > max_items:
+                abort(422)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(422)
+
+    if not items or len(items) > max_items:
+        abort(422)
+    return items
+
+
+# Checks every item with model.clean(), like the single item endpoints.
+# Accepts: model (class) and items (list)
+# Returns: rows to insert (list of dictionaries) and errors (list)
+def validate_items(model, items):
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'message': 'Not an object.'})
+            continue
+
+        values, invalid = model.clean(item)
+        missing = [field for field in model.REQUIRED_FIELDS
+                   if field not in values and field not in invalid]
+        if missing or invalid:
+            errors.append({
+                'index': index,
+                'missing': missing,
+                'invalid': invalid
+            })
+            continue
+
+        rows.append(values)
+    return rows, errors
+
+
+# Reads the "ids" list of a bulk PATCH or DELETE body.
+# Aborts with 422 unless it is a non-empty list of at most
+# BULK_MAX_ITEMS integer ids.
+# Returns: ids without duplicates (list)
+def read_ids(ids):
+    max_items = current_app.config.get('BULK_MAX_ITEMS', 10000)
+
+    if not isinstance(ids, list) or not ids or len(ids) > max_items:
+        abort(422)
+    for row_id in ids:
+        if not isinstance(row_id, int) or isinstance(row_id, bool):
+            abort(422)
+    return list(dict.fromkeys(ids))
+
+
+# Keeps the fields of `data` a PATCH may change, skipping empty values
+# like the single item PATCH endpoints do. Aborts with 422 on invalid
+# values.
+# Returns: values (dictionary)
+def read_values(model, data):
+    if not isinstance(data, dict):
+        abort(422)
+
+    values, invalid = model.clean(data)
+    if invalid:
+        abort(422)
+    return values
+
+
+# Reads the body of a bulk PATCH, either
+#   {"ids": [1, 2], "changes": {...}}  to apply the same changes, or
+#   {"items": [{"id": 1, ...}, ...]}   to apply changes per id.
+# Aborts with 422 if there is nothing to change.
+# Returns: changes (dictionary of id to values)
+def read_changes(model):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(422)
+
+    if 'items' in data:
+        items = data['items']
+        if not isinstance(items, list):
+            abort(422)
+        ids = read_ids([
+            item.get('id') if isinstance(item, dict) else None
+            for item in items
+        ])
+        changes = {item['id']: read_values(model, item) for item in items}
+    else:
+        ids = read_ids(data.get('ids'))
+        values = read_values(model, data.get('changes'))
+        changes = {row_id: values for row_id in ids}
+
+    changes = {row_id: values for row_id, values in changes.items()
+               if values}
+    if not changes:
+        abort(422)
+    return changes
@@ -0,0 +1,248 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from flask import current_app, make_response, request
+from functools import wraps
+from urllib.parse import urlencode
+from auth import get_current_token
+from compression import (
+    available_encodings, compress_response, encoded_etag, negotiate_encoding
+)
+from models import get_table_versions, on_tables_changed
+
+# ---------------------------------------------------------
+# Response cache backends
+# ---------------------------------------------------------
+
+
+# A cached GET response; `encoding` is its Content-Encoding, if any.
+CachedResponse = namedtuple(
+    'CachedResponse', ['body', 'status', 'mimetype', 'etag', 'encoding'],
+    defaults=[None])
+
+
+# Interface of response cache backends.
+# Values are tagged with the tables they were built from and
+# invalidate(tag) drops every value with that tag. Any object with
+# these methods can be passed to init_cache(), e.g. a fake in tests.
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, tags=()):
+        raise NotImplementedError
+
+    def invalidate(self, tag):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+# In-process, thread-safe LRU backend holding at most `maxsize` values.
+class LRUCache(CacheBackend):
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, tuple(tags))
+            self._bytes += len(value.body)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        value, tags = entry
+        self._bytes -= len(value.body)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+
+    # Returns: dictionary with size, bytes, hits, misses and hit_ratio.
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+# Backends of every app, invalidated whenever models commit changes.
+backends = weakref.WeakSet()
+
+
+@on_tables_changed
+def invalidate_backends(tables):
+    for backend in list(backends):
+        for table in tables:
+            backend.invalidate(table)
+
+
+# Sets up the response cache of `app`.
+# Uses `backend` if given, otherwise an LRUCache of RESPONSE_CACHE_SIZE
+# entries; a size of 0 disables the cache.
+def init_cache(app, backend=None):
+    if backend is None:
+        size = app.config.get('RESPONSE_CACHE_SIZE', 0)
+        backend = LRUCache(size) if size > 0 else None
+
+    app.extensions['response_cache'] = backend
+    if backend is not None:
+        backends.add(backend)
+    return backend
+
+
+# Returns: the stats of the response cache of the current app, or an
+# empty dictionary when it is disabled.
+def cache_stats():
+    cache = current_app.extensions.get('response_cache')
+    return cache.stats() if cache is not None else {}
+
+# ---------------------------------------------------------
+# Conditional GET
+# ---------------------------------------------------------
+
+
+# Builds a strong ETag for the request path and sorted query parameters
+# at `versions`.
+# Returns: etag (string, unquoted)
+def make_etag(versions):
+    query = urlencode(sorted(request.args.items(multi=True)))
+    key = '{}?{}|{}'.format(
+        request.path, query, ','.join(str(version) for version in versions))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# Builds the response cache key of an ETag for the caller's permissions.
+# Returns: key (string)
+def make_cache_key(etag):
+    token = get_current_token()
+    scope = ' '.join(sorted(token.permissions or ())) if token else ''
+    return '{}|{}|{}'.format(request.endpoint, etag, scope)
+
+
+# Answers the request with 304 if its If-None-Match has `etag` or the ETag
+# of one of its compressed representations.
+# Returns: response, or None
+def not_modified(etag):
+    for tag in [etag] + [encoded_etag(etag, encoding)
+                         for encoding in available_encodings()]:
+        if request.if_none_match.contains(tag):
+            response = current_app.response_class(status=304)
+            response.set_etag(tag)
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+# Decorator for cacheable GET endpoints reading `tables`.
+# The ETag comes from the version counters of `tables`, read with one
+# cheap query. A matching If-None-Match is answered with 304, and a
+# response cached for the same ETag and permissions is replayed, both
+# without running the endpoint. Endpoints may set an ETag of their own,
+# e.g. the version of the row they read; it is kept and checked against
+# If-None-Match once the response is built or replayed.
+# Must be applied below requires_auth().
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(get_table_versions(tables))
+            response = not_modified(etag)
+            if response is not None:
+                return response
+
+            cache = current_app.extensions.get('response_cache')
+            if cache is not None:
+                key = make_cache_key(encoded_etag(etag, negotiate_encoding()))
+                cached = cache.get(key)
+                if cached is not None:
+                    response = not_modified(cached.etag)
+                    if response is not None:
+                        return response
+                    response = current_app.response_class(
+                        cached.body, status=cached.status,
+                        mimetype=cached.mimetype)
+                    response.set_etag(cached.etag)
+                    if cached.encoding:
+                        response.headers['Content-Encoding'] = cached.encoding
+                        response.vary.add('Accept-Encoding')
+                    return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            own_etag = response.get_etag()[0]
+            if own_etag is None:
+                response.set_etag(etag)
+            if cache is not None and not response.is_streamed:
+                # Cached compressed, so hits skip the compression.
+                compress_response(response)
+                cache.set(key, CachedResponse(
+                    response.get_data(), response.status_code,
+                    response.mimetype, response.get_etag()[0],
+                    response.headers.get('Content-Encoding')), tables)
+            if own_etag is not None:
+                return not_modified(own_etag) or response
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+# ---------------------------------------------------------
+# Conditional writes
+# ---------------------------------------------------------
+
+
+# Reads the row versions an If-Match header accepts: the ETags of item
+# responses are the row versions, e.g. "3", or "3-gzip" when compressed.
+# Weak ETags never match.
+# Returns: versions (list of int), or None without If-Match or with "*"
+def get_if_match_versions():
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = []
+    for tag in if_match.as_set():
+        version = tag.split('-', 1)[0]
+        if version.isdigit():
+            versions.append(int(version))
+    return versions
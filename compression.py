@@ -0,0 +1,161 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import time
+import zlib
+from flask import current_app, request
+from metrics import record_phase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ---------------------------------------------------------
+# Response compression
+# ---------------------------------------------------------
+
+# Content types worth compressing.
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'application/x-ndjson',
+    'text/html',
+    'text/plain'
+)
+
+
+# Encodings the server can produce, preferred first.
+# Returns: list of encoding names
+def available_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+# Picks the encoding of the response from the Accept-Encoding header.
+# Returns: encoding name, or None to send the body as is
+def negotiate_encoding():
+    return request.accept_encodings.best_match(available_encodings())
+
+
+# Compresses `body` with `encoding`. Gzip members are written with a zero
+# mtime so the same body always compresses to the same bytes.
+# Returns: bytes
+def compress(body, encoding):
+    config = current_app.config
+    started = time.perf_counter()
+    if encoding == 'br':
+        compressed = brotli.compress(
+            body, quality=config.get('COMPRESS_BROTLI_LEVEL', 4))
+    else:
+        compressor = zlib.compressobj(
+            config.get('COMPRESS_LEVEL', 6), zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+    record_phase('compress', time.perf_counter() - started)
+    return compressed
+
+
+# Compresses a stream chunk by chunk with `encoding`, flushing after
+# every chunk so that each one reaches the client as soon as it is sent.
+# finish() returns the end of the compressed stream.
+class StreamCompressor:
+    def __init__(self, encoding, level, brotli_level):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=brotli_level)
+            self._compress = compressor.process
+            self._flush = compressor.flush
+            self.finish = compressor.finish
+        else:
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+
+    # Returns: the compressed bytes of `chunk` (bytes)
+    def compress(self, chunk):
+        return self._compress(chunk) + self._flush()
+
+
+# Compresses the `chunks` of a streamed body with `compressor`, closing
+# them when the stream ends or is abandoned.
+# Returns: generator of bytes
+def compress_chunks(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+# Returns: the ETag of the `encoding` representation of `etag`.
+def encoded_etag(etag, encoding):
+    return f'{etag}-{encoding}' if encoding else etag
+
+
+# Compresses `response` in place for the client, unless it is already
+# encoded, not text or smaller than COMPRESS_MIN_SIZE bytes. Streamed
+# responses, whose size is unknown, are always compressed as they are
+# sent, one flush per chunk.
+# Registered as an after_request hook; conditional() also calls it
+# before caching so that cache hits are served already compressed.
+# Returns: response
+def compress_response(response):
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    if response.is_streamed:
+        return compress_stream(response)
+
+    body = response.get_data()
+    if len(body) < current_app.config.get('COMPRESS_MIN_SIZE', 500):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    compressed = compress(body, encoding)
+    if len(compressed) >= len(body):
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
+
+
+# Compresses the streamed body of `response` as it is sent.
+# Returns: response
+def compress_stream(response):
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    config = current_app.config
+    compressor = StreamCompressor(
+        encoding, config.get('COMPRESS_LEVEL', 6),
+        config.get('COMPRESS_BROTLI_LEVEL', 4))
+    response.response = compress_chunks(response.response, compressor)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
+
+
+# Compresses the responses of `app` with compress_response().
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,47 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from flask import abort, request
+from sqlalchemy import func
+
+# ---------------------------------------------------------
+# Filtering
+# ---------------------------------------------------------
+
+# Comparison operators allowed in model.FILTERS.
+OPERATORS = {
+    '==': lambda column, value: column == value,
+    '>=': lambda column, value: column >= value,
+    '<=': lambda column, value: column <= value
+}
+
+
+# Escapes the LIKE wildcards in `value` so it only matches literally.
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+# Applies the filter query parameters listed in model.FILTERS to `query`.
+# Prefixes are matched case-insensitively with lower(field) LIKE 'x%',
+# which the lower() indexes on the name and title columns can serve.
+# Aborts with 422 if a value cannot be parsed.
+# Returns: Query
+def apply_filters(model, query):
+    for name, (field, operator, parser) in model.FILTERS.items():
+        value = request.args.get(name)
+        if value is None or value == '':
+            continue
+        value = parser(value)
+        if value is None:
+            abort(422)
+
+        column = getattr(model, field)
+        if operator == 'prefix':
+            pattern = escape_like(value.lower()) + '%'
+            query = query.filter(
+                func.lower(column).like(pattern, escape='\\'))
+        else:
+            query = query.filter(OPERATORS[operator](column, value))
+    return query
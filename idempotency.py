@@ -0,0 +1,201 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import abort, current_app, make_response, request
+from functools import wraps
+from werkzeug.exceptions import HTTPException
+from auth import get_current_token
+
+# ---------------------------------------------------------
+# Idempotency key stores
+# ---------------------------------------------------------
+
+# Longest accepted Idempotency-Key header.
+MAX_KEY_LENGTH = 255
+
+
+# The response stored for an idempotency key; `headers` are the
+# (name, value) pairs set by the endpoint, e.g. Content-Type and ETag.
+StoredResponse = namedtuple('StoredResponse', ['body', 'status', 'headers'])
+
+
+# A reserved idempotency key: the fingerprint of the request that used it
+# and its response, None while that request is still running.
+IdempotencyEntry = namedtuple(
+    'IdempotencyEntry', ['fingerprint', 'response', 'expires_at'])
+
+
+# Interface of idempotency key stores. Any object with these methods
+# can be passed to init_idempotency(), e.g. one shared by every worker.
+class IdempotencyStore:
+    # Reserves `key` for the request with `fingerprint`, unless it is
+    # already reserved.
+    # Returns: the existing IdempotencyEntry, or None if it was reserved
+    def reserve(self, key, fingerprint):
+        raise NotImplementedError
+
+    # Stores the StoredResponse of a reserved `key`.
+    def complete(self, key, response):
+        raise NotImplementedError
+
+    # Drops the reservation of `key`, so that the request can be retried.
+    def release(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+# In-process, thread-safe store keeping each key for `ttl` seconds, and
+# at most `maxsize` keys.
+class MemoryIdempotencyStore(IdempotencyStore):
+    def __init__(self, ttl=86400, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.replays = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key, fingerprint):
+        now = time.time()
+        with self._lock:
+            # Entries are kept in reservation order, so the expired
+            # ones come first.
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest.expires_at > now:
+                    break
+                self._entries.popitem(last=False)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.response is not None and \
+                        entry.fingerprint == fingerprint:
+                    self.replays += 1
+                return entry
+
+            self._entries[key] = IdempotencyEntry(
+                fingerprint, None, now + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return None
+
+    def complete(self, key, response):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = entry._replace(response=response)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # Returns: dictionary with size and replays.
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'replays': self.replays}
+
+
+# Sets up the idempotency key store of `app`.
+# Uses `store` if given, otherwise a MemoryIdempotencyStore keeping
+# IDEMPOTENCY_STORE_SIZE keys for IDEMPOTENCY_TTL seconds; a size of 0
+# disables Idempotency-Key support.
+def init_idempotency(app, store=None):
+    if store is None:
+        size = app.config.get('IDEMPOTENCY_STORE_SIZE', 0)
+        if size > 0:
+            store = MemoryIdempotencyStore(
+                app.config.get('IDEMPOTENCY_TTL', 86400), size)
+
+    app.extensions['idempotency'] = store
+    return store
+
+
+# Returns: the stats of the idempotency key store of the current app,
+# or an empty dictionary when it is disabled.
+def idempotency_stats():
+    store = current_app.extensions.get('idempotency')
+    return store.stats() if store is not None else {}
+
+# ---------------------------------------------------------
+# Idempotent requests
+# ---------------------------------------------------------
+
+
+# Hashes the method, path, query string and body of the request, so a
+# key reused for another request can be told apart.
+# Returns: fingerprint (string)
+def request_fingerprint():
+    digest = hashlib.sha256()
+    for part in (request.method, request.path,
+                 request.query_string.decode('latin-1')):
+        digest.update(part.encode('utf-8') + b'\0')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+# Decorator for write endpoints accepting an Idempotency-Key header.
+# The first request with a key runs the endpoint and its response is
+# stored; a retry with the same key and request is answered with that
+# response and an Idempotent-Replayed header, without running the
+# endpoint. Reusing a key for another request is rejected with 422, and
+# a retry while the first request still runs with 409. Keys are scoped
+# to the "sub" of the token. Endpoints that fail with an exception or a
+# 5xx response release the key, so they can be retried.
+# Must be applied below requires_auth().
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        store = current_app.extensions.get('idempotency')
+        if key is None or store is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(422)
+
+        token = get_current_token()
+        subject = token.payload.get('sub', '') if token else ''
+        scoped_key = '{}|{}'.format(subject, key)
+        fingerprint = request_fingerprint()
+
+        entry = store.reserve(scoped_key, fingerprint)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                abort(422)
+            if entry.response is None:
+                abort(409)
+            stored = entry.response
+            response = current_app.response_class(
+                stored.body, status=stored.status, headers=stored.headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            try:
+                response = make_response(f(*args, **kwargs))
+            except HTTPException as error:
+                # Errors such as abort(404) are stored as the error
+                # handlers of the app answer them, so a retry gets the
+                # same response.
+                if error.code is None or error.code >= 500:
+                    raise
+                response = make_response(
+                    current_app.handle_user_exception(error))
+        except BaseException:
+            store.release(scoped_key)
+            raise
+
+        if response.status_code >= 500 or response.is_streamed:
+            store.release(scoped_key)
+        else:
+            store.complete(scoped_key, StoredResponse(
+                response.get_data(), response.status_code,
+                list(response.headers)))
+        return response
+
+    return wrapper
@@ -0,0 +1,79 @@
+# ---------------------------------------------------------
+# Local token issuer
+#
+# Stands in for Auth0 in benchmarks and tests: a locally generated RSA
+# key signs tokens with the issuer and audience auth.py expects, and its
+# public half is published as a JWKS file that JWKS_URL can point to.
+# ---------------------------------------------------------
+
+import base64
+import json
+import os
+import time
+import rsa
+from jose import jwt
+from auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN
+
+# Every permission used by the routes of app.py.
+ALL_PERMISSIONS = (
+    'get:actors', 'get:movies',
+    'post:actors', 'post:movies',
+    'patch:actor', 'patch:movie',
+    'delete:actor', 'delete:movie',
+    'get:metrics', 'get:profiles'
+)
+
+
+# Encodes a positive integer as unpadded base64url, as JWKs do.
+def encode_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+# Signs tokens with a fresh RSA key identified by `kid`. The key is
+# 1024 bits by default since the pure Python rsa package takes seconds
+# to generate larger ones; it never leaves the process.
+class LocalIssuer:
+    def __init__(self, kid='local', bits=1024):
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+        self.private_pem = self.private_key.save_pkcs1().decode('ascii')
+
+    # Returns: the JSON web key set of the public key (dictionary)
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'use': 'sig',
+            'alg': ALGORITHMS[0],
+            'kid': self.kid,
+            'n': encode_int(self.public_key.n),
+            'e': encode_int(self.public_key.e)
+        }]}
+
+    # Writes jwks() to `path`.
+    # Returns: its file:// URL, for JWKS_URL
+    def write_jwks(self, path):
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+        return 'file://' + os.path.abspath(path)
+
+    # Signs a token of `subject` with `permissions`, valid for
+    # `expires_in` seconds (negative for an expired token).
+    # Returns: token (string)
+    def token(self, permissions=ALL_PERMISSIONS, subject='local|user',
+              expires_in=3600, **claims):
+        now = int(time.time())
+        claims = dict({
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'sub': subject,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }, **claims)
+        return jwt.encode(claims, self.private_pem, algorithm=ALGORITHMS[0],
+                          headers={'kid': self.kid})
+
+    # Returns: Authorization header of token() (dictionary)
+    def auth_header(self, *args, **kwargs):
+        return {'Authorization': 'Bearer ' + self.token(*args, **kwargs)}
@@ -0,0 +1,259 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import bisect
+import threading
+import time
+from flask import current_app, request, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ---------------------------------------------------------
+# Metric types
+# ---------------------------------------------------------
+
+# Upper bounds of the histogram buckets: seconds, bytes and counts.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+PREFIX = 'agency_'
+
+
+# Escapes a label value of the Prometheus text format.
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+# Formats `labels` and `values` as {name="value",...}.
+def format_labels(labels, values):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{label}="{escape(value)}"'
+                          for label, value in zip(labels, values)) + '}'
+
+
+# Thread-safe counter, one value per tuple of label values.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, values=(), amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    # Returns: the lines of the counter in the Prometheus text format.
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{format_labels(self.labels, key)} {value}'
+
+
+# Thread-safe histogram with fixed `buckets`, one series per tuple of
+# label values.
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (+Inf last), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    # Returns: the lines of the histogram in the Prometheus text format,
+    # with cumulative buckets.
+    def render(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._series.items())
+        labels = self.labels + ('le',)
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name, format_labels(labels, key + (bound,)),
+                    cumulative)
+            suffix = format_labels(self.labels, key)
+            yield f'{self.name}_sum{suffix} {total}'
+            yield f'{self.name}_count{suffix} {cumulative}'
+
+# ---------------------------------------------------------
+# Registry
+# ---------------------------------------------------------
+
+
+# Keys of the stats dictionaries that only grow, exported as counters.
+COUNTER_STATS = frozenset({
+    'hits', 'misses', 'checkouts', 'timeouts', 'wait_seconds_total',
+    'replays'})
+
+
+# Metrics of one app. `stats` maps a name to a callable returning a
+# dictionary, e.g. TokenCache.stats; its numeric values are exported as
+# <name>_<key> when the metrics are scraped, the COUNTER_STATS as
+# counters ending in _total and the others as gauges.
+class Metrics:
+    def __init__(self, stats=None):
+        self.stats = dict(stats or {})
+        self.requests = Counter(
+            'http_requests_total', 'Requests handled.',
+            ('route', 'method', 'status'))
+        self.duration = Histogram(
+            'http_request_duration_seconds',
+            'Time from the start of a request to its response.',
+            ('route', 'method'))
+        self.phases = Histogram(
+            'http_request_phase_seconds',
+            'Time spent in each phase of a request; phases may nest.',
+            ('route', 'phase'))
+        self.queries = Histogram(
+            'http_request_queries', 'SQL queries run by a request.',
+            ('route',), COUNT_BUCKETS)
+        self.sizes = Histogram(
+            'http_response_size_bytes', 'Size of the response bodies.',
+            ('route',), SIZE_BUCKETS)
+        self.query_duration = Histogram(
+            'db_query_duration_seconds', 'Duration of single SQL queries.')
+
+    # Records the measurements of a finished request.
+    def observe(self, timings, route, method, status, size):
+        elapsed = time.perf_counter() - timings.started
+        self.requests.inc((route, method, str(status)))
+        self.duration.observe((route, method), elapsed)
+        for phase, seconds in timings.phases.items():
+            self.phases.observe((route, phase), seconds)
+        self.queries.observe((route,), timings.queries)
+        if size is not None:
+            self.sizes.observe((route,), size)
+
+    # Returns: every metric in the Prometheus text format (string)
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.duration, self.phases,
+                       self.queries, self.sizes, self.query_duration):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+
+        for name, collect in self.stats.items():
+            for key, value in collect().items():
+                if isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    continue
+                metric = f'{PREFIX}{name}_{key}'
+                kind = 'gauge'
+                if key in COUNTER_STATS:
+                    kind = 'counter'
+                    if not metric.endswith('_total'):
+                        metric += '_total'
+                lines.append(f'# TYPE {metric} {kind}')
+                lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+# ---------------------------------------------------------
+# Request timings
+# ---------------------------------------------------------
+
+
+# Time spent per phase and SQL queries run by the current request.
+class RequestTimings:
+    __slots__ = ('started', 'phases', 'queries')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+
+
+# Returns: the RequestTimings of the current request, or None.
+def get_request_timings():
+    return getattr(_request_ctx_stack.top, 'request_timings', None)
+
+
+# Adds `seconds` to `phase` of the current request. Does nothing outside
+# of a request, e.g. on the background JWKS refresh thread.
+def record_phase(phase, seconds):
+    timings = getattr(_request_ctx_stack.top, 'request_timings', None)
+    if timings is not None:
+        timings.phases[phase] = timings.phases.get(phase, 0.0) + seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    timings = get_request_timings()
+    if timings is not None:
+        elapsed = time.perf_counter() - started
+        timings.queries += 1
+        timings.phases['sql'] = timings.phases.get('sql', 0.0) + elapsed
+        current_app.extensions['metrics'].query_duration.observe((), elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def fail_query(context):
+    started = context.connection.info.get('query_started')
+    if started:
+        started.pop()
+
+
+def start_request():
+    _request_ctx_stack.top.request_timings = RequestTimings()
+
+
+# Routes are labelled by their rule, e.g. /actors/<int:actor_id>, so that
+# the number of series stays bounded.
+def end_request(response):
+    timings = get_request_timings()
+    if timings is not None:
+        rule = request.url_rule
+        size = None if response.is_streamed else \
+            response.calculate_content_length()
+        current_app.extensions['metrics'].observe(
+            timings, rule.rule if rule else 'unmatched', request.method,
+            response.status_code, size)
+    return response
+
+
+# Records the metrics of every request of `app`, with the gauges of
+# `stats` (see Metrics). Must run before the other after_request hooks
+# are registered so that it sees the final, compressed response.
+# Returns: Metrics
+def init_metrics(app, stats=None):
+    metrics = app.extensions['metrics'] = Metrics(stats)
+    app.before_request(start_request)
+    app.after_request(end_request)
+    return metrics
+
+
+# Returns: the metrics of the current app in the Prometheus text format
+def render_metrics():
+    return current_app.extensions['metrics'].render()
@@ -0,0 +1,55 @@
+"""create actors and movies
+
+Databases created before the migrations by db.create_all() already have
+these tables, with the same columns; they are kept as they are, so that
+`python manage.py db upgrade` adopts such a database without a stamp.
+
+Revision ID: 0219ef911d7a
+Revises: 
+Create Date: 2026-10-17 04:00:43.940053
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0219ef911d7a'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'actors' not in existing:
+        create_actors()
+    if 'movies' not in existing:
+        create_movies()
+
+
+def create_actors():
+    op.create_table(
+        'actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('age', sa.String(), nullable=True),
+        sa.Column('gender', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def create_movies():
+    op.create_table(
+        'movies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('release', sa.Date(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('movies')
+    op.drop_table('actors')
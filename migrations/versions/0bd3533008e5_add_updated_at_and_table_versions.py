@@ -0,0 +1,48 @@
+"""add updated_at and table versions
+
+Revision ID: 0bd3533008e5
+Revises: 0219ef911d7a
+Create Date: 2026-10-17 04:00:48.319441
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0bd3533008e5'
+down_revision = '0219ef911d7a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A constant default lets Postgres add the column without a rewrite.
+    # SQLite cannot add a column with a CURRENT_TIMESTAMP default to a
+    # table with rows, e.g. one adopted from db.create_all(), so batch mode
+    # copies the table there.
+    recreate = 'always' if op.get_bind().dialect.name == 'sqlite' \
+        else 'auto'
+    for table in ('actors', 'movies'):
+        with op.batch_alter_table(table, recreate=recreate) as batch_op:
+            batch_op.add_column(sa.Column(
+                'updated_at', sa.DateTime(), nullable=False,
+                server_default=sa.text('CURRENT_TIMESTAMP')))
+
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'actors', 'version': 0},
+        {'name': 'movies', 'version': 0}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    for table in ('movies', 'actors'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,40 @@
+"""add movie cast
+
+Adds the movie_cast association table linking movies and their actors.
+It is new and empty, so creating it does not lock the existing tables
+for long.
+
+Revision ID: 0f04b598f032
+Revises: e24ed81adf0a
+Create Date: 2026-10-17 04:10:24.082930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0f04b598f032'
+down_revision = 'e24ed81adf0a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'movie_cast',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['actor_id'], ['actors.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(
+            ['movie_id'], ['movies.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_movie_cast_actor_id'), 'movie_cast',
+                    ['actor_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_movie_cast_actor_id'), table_name='movie_cast')
+    op.drop_table('movie_cast')
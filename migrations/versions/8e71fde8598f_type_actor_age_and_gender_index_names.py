@@ -0,0 +1,136 @@
+"""type actor age and gender, index names
+
+Converts actors.age from text to integer, limits actors.gender to the
+values of models.GENDERS and adds the B-tree indexes used for sorting and
+prefix search.
+
+On Postgres every step is safe to run while the app is serving:
+  1. a new integer column is added (metadata only),
+  2. it is backfilled in committed batches of BATCH_SIZE ids,
+  3. a short transaction catches up rows written since the backfill
+     started, found through a temporary index on updated_at built
+     concurrently beforehand, and swaps the columns; it gives up after
+     LOCK_TIMEOUT rather than queue writes behind long transactions,
+  4. the gender constraint is added NOT VALID, then validated without
+     blocking writes,
+  5. indexes are built with CREATE INDEX CONCURRENTLY.
+Ages that are not whole numbers become NULL and unknown genders 'other'.
+
+Revision ID: 8e71fde8598f
+Revises: 0bd3533008e5
+Create Date: 2026-10-17 04:02:22.403350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e71fde8598f'
+down_revision = '0bd3533008e5'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+LOCK_TIMEOUT = '5s'
+GENDERS = ('female', 'male', 'non-binary', 'other')
+GENDER_LIST = ', '.join(f"'{gender}'" for gender in GENDERS)
+
+INDEXES = (
+    ('ix_actors_name_id', 'actors', 'name, id'),
+    ('ix_actors_name_lower', 'actors', 'lower(name) text_pattern_ops'),
+    ('ix_movies_title_id', 'movies', 'title, id'),
+    ('ix_movies_title_lower', 'movies', 'lower(title) text_pattern_ops'),
+    ('ix_movies_release_id', 'movies', 'release, id'),
+)
+
+# Converts one batch of actors; :low and :high bound the ids.
+BACKFILL = f"""
+    UPDATE actors SET
+        age_years = CASE WHEN trim(age) ~ '^[0-9]{{1,3}}$'
+                         THEN trim(age)::integer END,
+        gender = CASE WHEN lower(trim(gender)) IN ({GENDER_LIST})
+                      THEN lower(trim(gender))
+                      WHEN gender IS NOT NULL THEN 'other' END
+    WHERE id > :low AND id <= :high
+"""
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        upgrade_offline_copy()
+        return
+
+    op.add_column('actors', sa.Column('age_years', sa.Integer()))
+    # updated_at is written in UTC by the app; a minute of margin covers
+    # clock skew between the app servers and the database.
+    started_at = op.get_bind().execute(sa.text(
+        "SELECT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') "
+        "- INTERVAL '1 minute'")).scalar()
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        max_id = bind.execute(
+            sa.text('SELECT coalesce(max(id), 0) FROM actors')).scalar()
+        for low in range(0, max_id, BATCH_SIZE):
+            bind.execute(sa.text(BACKFILL),
+                         low=low, high=low + BATCH_SIZE)
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                   'ix_actors_updated_at_tmp ON actors (updated_at)')
+
+    # Rows written by the running app since the backfill started.
+    op.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    op.execute('LOCK TABLE actors IN SHARE ROW EXCLUSIVE MODE')
+    op.get_bind().execute(sa.text(
+        BACKFILL.replace('id > :low AND id <= :high',
+                         'updated_at >= :started_at')),
+        started_at=started_at)
+    op.drop_column('actors', 'age')
+    op.alter_column('actors', 'age_years', new_column_name='age')
+    op.execute(f'ALTER TABLE actors ADD CONSTRAINT ck_actors_gender '
+               f'CHECK (gender IN ({GENDER_LIST})) NOT VALID')
+
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY ix_actors_updated_at_tmp')
+        op.execute('ALTER TABLE actors VALIDATE CONSTRAINT ck_actors_gender')
+        for name, table, columns in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON {table} ({columns})')
+
+
+# SQLite and other databases: convert the data in place, then let batch
+# mode copy the table with the new column type and constraint.
+def upgrade_offline_copy():
+    op.execute("UPDATE actors SET age = NULL WHERE trim(age) = '' "
+               "OR trim(age) GLOB '*[^0-9]*' OR length(trim(age)) > 3")
+    op.execute('UPDATE actors SET gender = lower(trim(gender))')
+    op.execute(f"UPDATE actors SET gender = 'other' "
+               f"WHERE gender NOT IN ({GENDER_LIST})")
+
+    with op.batch_alter_table('actors') as batch_op:
+        batch_op.alter_column(
+            'age', type_=sa.Integer(), existing_type=sa.String())
+        batch_op.create_check_constraint(
+            'ck_actors_gender', f'gender IN ({GENDER_LIST})')
+
+    for name, table, columns in INDEXES:
+        columns = columns.replace(' text_pattern_ops', '')
+        op.execute(f'CREATE INDEX {name} ON {table} ({columns})')
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint('ck_actors_gender', 'actors', type_='check')
+        op.alter_column('actors', 'age', type_=sa.String(),
+                        existing_type=sa.Integer(),
+                        postgresql_using='age::text')
+        return
+
+    # Batch mode rebuilds the table from its reflection, which does not
+    # include the CHECK constraint.
+    with op.batch_alter_table('actors') as batch_op:
+        batch_op.alter_column(
+            'age', type_=sa.String(), existing_type=sa.Integer())
@@ -0,0 +1,89 @@
+"""add search vectors
+
+Adds the search_vector columns used by /search.
+
+On Postgres they are tsvector columns filled by a trigger on every
+insert and every update of the name or title. Existing rows are
+backfilled in committed batches of BATCH_SIZE ids after the trigger is
+in place, so concurrent writes are never missed, and the GIN indexes are
+built with CREATE INDEX CONCURRENTLY. Other databases get unused text
+columns; the app searches them with an in-memory index.
+
+Revision ID: e24ed81adf0a
+Revises: 8e71fde8598f
+Create Date: 2026-10-17 04:07:38.425204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e24ed81adf0a'
+down_revision = '8e71fde8598f'
+branch_labels = None
+depends_on = None
+
+
+BATCH_SIZE = 10000
+
+# (table, searched column)
+SEARCHED = (
+    ('actors', 'name'),
+    ('movies', 'title'),
+)
+
+TRIGGER = """
+    CREATE TRIGGER {table}_search_vector
+    BEFORE INSERT OR UPDATE OF {column} ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(search_vector, 'pg_catalog.simple', {column})
+"""
+
+# Fills one batch of rows; :low and :high bound the ids.
+BACKFILL = """
+    UPDATE {table}
+    SET search_vector = to_tsvector('pg_catalog.simple',
+                                    coalesce({column}, ''))
+    WHERE id > :low AND id <= :high
+"""
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for table, column in SEARCHED:
+            op.add_column(table, sa.Column('search_vector', sa.Text()))
+            op.create_index(f'ix_{table}_search_vector', table,
+                            ['search_vector'])
+        return
+
+    for table, column in SEARCHED:
+        op.add_column(
+            table, sa.Column('search_vector', postgresql.TSVECTOR()))
+        op.execute(TRIGGER.format(table=table, column=column))
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        for table, column in SEARCHED:
+            max_id = bind.execute(sa.text(
+                f'SELECT coalesce(max(id), 0) FROM {table}')).scalar()
+            for low in range(0, max_id, BATCH_SIZE):
+                bind.execute(
+                    sa.text(BACKFILL.format(table=table, column=column)),
+                    low=low, high=low + BATCH_SIZE)
+
+        for table, column in SEARCHED:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                       f'ix_{table}_search_vector ON {table} '
+                       f'USING gin (search_vector)')
+
+
+def downgrade():
+    for table, column in reversed(SEARCHED):
+        op.drop_index(f'ix_{table}_search_vector', table_name=table)
+        if op.get_bind().dialect.name == 'postgresql':
+            op.execute(f'DROP TRIGGER {table}_search_vector ON {table}')
+        # SQLite 3.35+ drops the column in place, keeping the
+        # expression indexes and CHECK constraints a batch copy loses.
+        op.drop_column(table, 'search_vector')
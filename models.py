@@ -3,12 +3,16 @@
 # ---------------------------------------------------------
 from sqlalchemy import create_engine
 from sqlalchemy import Table, Column, Integer, String, Date
+from sqlalchemy import DDL, event, exc
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert as pg_insert
+from sqlalchemy.pool import QueuePool
 from flask_sqlalchemy import SQLAlchemy
 import json
 import os
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from flask_moment import Moment
+import threading
+import time
+from datetime import date, datetime
+from email.utils import parsedate_to_datetime
 
 # ---------------------------------------------------------
 # App Config.
@@ -20,58 +24,528 @@ if not database_path:
     database_path = "postgresql://{}/{}".format('postgres:XXXXXXX@localhost:5432', database_name)
 
 db = SQLAlchemy()
-moment = Moment()
+
+# ---------------------------------------------------------
+# Connection pool.
+# ---------------------------------------------------------
+
+
+# Counters of the time spent waiting for pooled connections.
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+pool_metrics = PoolMetrics()
+
+
+# QueuePool recording how long each checkout waits for a connection,
+# including the time to open a new one.
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out)
+
+
+# Builds the engine options from the DB_POOL_* settings of `config`.
+# SQLite keeps the pool SQLAlchemy picks for it.
+# Returns: options (dictionary)
+def engine_options(config, database_path):
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    }
+    if not database_path.startswith('sqlite'):
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT']
+        )
+    return options
+
+
+# Reports the state of the connection pool and its wait times.
+# Returns: dictionary
+def pool_status():
+    pool = db.engine.pool
+    status = {
+        'pool': type(pool).__name__,
+        'checkouts': pool_metrics.checkouts,
+        'timeouts': pool_metrics.timeouts,
+        'wait_seconds_total': pool_metrics.wait_seconds_total,
+        'wait_seconds_max': pool_metrics.wait_seconds_max
+    }
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow()
+        )
+    return status
 
 
 # Set-up database-related Flask modules.
-def setup_db(app, database_path=database_path):
-    app.config.from_pyfile('config.py', silent=False)
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+# Expects the app config to be loaded. Neither connects to the database
+# nor creates the schema: the engine is created on first use, and the
+# schema by the migrations (python manage.py db upgrade).
+# Connects to `path`, else to the SQLALCHEMY_DATABASE_URI of the config,
+# e.g. from create_app(test_config), else to DATABASE_URL.
+def setup_db(app, path=None):
+    database_uri = path or app.config.get("SQLALCHEMY_DATABASE_URI") or \
+        database_path
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault(
+        "SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config, database_uri))
     db.app = app
-    moment.app = app
     db.init_app(app)
-    db.create_all()
+
+
+# Increments the version of each table in `tables`, in the current
+# transaction, so cached representations of them become stale.
+def bump_versions(*tables):
+    table = TableVersion.__table__
+    for name in tables:
+        result = db.session.execute(table.update().where(
+            table.c.name == name).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(name=name, version=1))
+
+
+# Reads the current version of each table in `tables` in one query.
+# Returns: versions (list of int, 0 for tables never written)
+def get_table_versions(tables):
+    versions = dict(db.session.query(
+        TableVersion.name, TableVersion.version).filter(
+        TableVersion.name.in_(tables)))
+    return [versions.get(name, 0) for name in tables]
+
+
+# Callables notified with the names of the tables of each commit.
+change_listeners = []
+
+
+# Registers `listener` to be called with the changed table names after
+# every commit_changes().
+def on_tables_changed(listener):
+    change_listeners.append(listener)
+    return listener
+
+
+# Commits the session together with a version bump of `tables`.
+def commit_changes(*tables):
+    bump_versions(*tables)
+    db.session.commit()
+    for listener in change_listeners:
+        listener(tables)
+
+
+# Returns: the table of `model` and the tables linked to it through a
+# many-to-many relationship, whose listings embed its rows.
+def linked_tables(model):
+    tables = [model.__tablename__]
+    for relationship in model.__mapper__.relationships:
+        if relationship.secondary is not None:
+            tables.append(relationship.mapper.class_.__tablename__)
+    return tables
+
+
+# Deletes the association rows of the `ids` rows of `model`.
+def delete_links(model, ids):
+    for relationship in model.__mapper__.relationships:
+        if relationship.secondary is not None:
+            (_, column), = relationship.synchronize_pairs
+            db.session.execute(
+                relationship.secondary.delete().where(column.in_(ids)))
+
+
+# Checks whether the database can return generated ids from a
+# multi-row INSERT (INSERT ... RETURNING).
+def supports_returning():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+# Inserts many rows of `model` in one transaction.
+# Postgres gets one multi-row INSERT ... RETURNING per `chunk_size` rows;
+# other databases fall back to a bulk insert of the mappings.
+# Accepts: model (class), rows (list of dictionaries), chunk_size (int)
+# Returns: ids of the new rows (list)
+def insert_many(model, rows, chunk_size=1000):
+    table = model.__table__
+    ids = []
+    try:
+        for chunk in chunked(rows, chunk_size):
+            if supports_returning():
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids.extend(row[0] for row in result)
+            else:
+                db.session.bulk_insert_mappings(
+                    model, chunk, return_defaults=True)
+                ids.extend(row['id'] for row in chunk)
+        commit_changes(table.name)
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+# Splits `items` into lists of at most `size` items.
+def chunked(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+# Selects which of `ids` exist in the table of `model`.
+# Returns: ids (list)
+def existing_ids(model, ids, chunk_size=1000):
+    found = []
+    for chunk in chunked(ids, chunk_size):
+        found.extend(row[0] for row in db.session.query(model.id).filter(
+            model.id.in_(chunk)))
+    return sorted(found)
+
+
+# Updates rows of `model` by id in one transaction, incrementing their
+# versions. Ids that get the same values share one
+# UPDATE ... WHERE id IN statement, so a change applied to many rows
+# costs a single statement. Postgres reports the updated ids with
+# UPDATE ... RETURNING; other databases look them up first.
+# Accepts: model (class), changes (dictionary of id to column values)
+# Returns: ids of the rows that matched (list)
+def update_many(model, changes, chunk_size=1000):
+    table = model.__table__
+    try:
+        if supports_returning():
+            ids = list(changes)
+        else:
+            ids = existing_ids(model, list(changes), chunk_size)
+
+        groups = {}
+        for row_id in ids:
+            values = tuple(sorted(changes[row_id].items()))
+            groups.setdefault(values, []).append(row_id)
+
+        matched = []
+        for values, ids in groups.items():
+            for chunk in chunked(ids, chunk_size):
+                statement = table.update().where(
+                    table.c.id.in_(chunk)).values(
+                    dict(values, version=table.c.version + 1))
+                if supports_returning():
+                    result = db.session.execute(
+                        statement.returning(table.c.id))
+                    matched.extend(row[0] for row in result)
+                else:
+                    db.session.execute(statement)
+                    matched.extend(chunk)
+        commit_changes(*linked_tables(model))
+    except Exception:
+        db.session.rollback()
+        raise
+    return sorted(matched)
+
+
+# Updates row `row_id` of `model` with `values` and increments its
+# version in a single UPDATE ... WHERE id = ? statement. With `versions`,
+# e.g. from If-Match, the row is only updated while its version is one of
+# them, so concurrent writers cannot overwrite each other's changes.
+# Postgres returns the updated row with UPDATE ... RETURNING; other
+# databases select it afterwards, in the same transaction.
+# Accepts: model (class), row_id (int), values (dictionary),
+# versions (list of int, or None for any version)
+# Returns: the FIELDS of the updated row (dictionary), or None if no row
+# matched
+def update_one(model, row_id, values, versions=None):
+    table = model.__table__
+    condition = table.c.id == row_id
+    if versions is not None:
+        if not versions:
+            return None
+        condition &= table.c.version.in_(versions)
+    statement = table.update().where(condition).values(
+        dict(values, version=table.c.version + 1))
+    columns = [table.c[field] for field in model.FIELDS]
+    try:
+        if supports_returning():
+            row = db.session.execute(statement.returning(*columns)).first()
+        elif db.session.execute(statement).rowcount:
+            row = db.session.query(*columns).filter(
+                table.c.id == row_id).one()
+        else:
+            row = None
+
+        if row is None:
+            db.session.rollback()
+            return None
+        commit_changes(*linked_tables(model))
+    except Exception:
+        db.session.rollback()
+        raise
+    return dict(zip(model.FIELDS, row))
+
+
+# Deletes rows of `model` by id in one transaction.
+# Postgres reports the deleted ids with DELETE ... RETURNING; other
+# databases look them up first.
+# Accepts: model (class), ids (list)
+# Returns: ids of the rows that matched (list)
+def delete_many(model, ids, chunk_size=1000):
+    table = model.__table__
+    matched = []
+    try:
+        for chunk in chunked(ids, chunk_size):
+            if supports_returning():
+                delete_links(model, chunk)
+                result = db.session.execute(table.delete().where(
+                    table.c.id.in_(chunk)).returning(table.c.id))
+                matched.extend(row[0] for row in result)
+            else:
+                found = existing_ids(model, chunk, chunk_size)
+                delete_links(model, found)
+                db.session.execute(table.delete().where(
+                    table.c.id.in_(found)))
+                matched.extend(found)
+        commit_changes(*linked_tables(model))
+    except Exception:
+        db.session.rollback()
+        raise
+    return sorted(matched)
+
+# Adds the `actor_ids` actors to the cast of movie `movie_id`, skipping
+# unknown actors and keeping those already cast.
+# Returns: ids of the known actors, all now in the cast (list)
+def add_to_cast(movie_id, actor_ids, chunk_size=1000):
+    try:
+        found = existing_ids(Actor, actor_ids, chunk_size)
+        rows = [{'movie_id': movie_id, 'actor_id': actor_id}
+                for actor_id in found]
+        if supports_returning():
+            # Postgres skips pairs added concurrently as well.
+            for chunk in chunked(rows, chunk_size):
+                db.session.execute(
+                    pg_insert(movie_cast).on_conflict_do_nothing(), chunk)
+        else:
+            cast = set()
+            for chunk in chunked(found, chunk_size):
+                cast.update(row[0] for row in db.session.query(
+                    movie_cast.c.actor_id).filter(
+                    movie_cast.c.movie_id == movie_id,
+                    movie_cast.c.actor_id.in_(chunk)))
+            rows = [row for row in rows if row['actor_id'] not in cast]
+            if rows:
+                db.session.execute(movie_cast.insert(), rows)
+        commit_changes('movies', 'actors')
+    except Exception:
+        db.session.rollback()
+        raise
+    return found
+
+
+# Removes actor `actor_id` from the cast of movie `movie_id`.
+# Returns: whether the actor was in the cast (bool)
+def remove_from_cast(movie_id, actor_id):
+    try:
+        result = db.session.execute(movie_cast.delete().where(
+            (movie_cast.c.movie_id == movie_id) &
+            (movie_cast.c.actor_id == actor_id)))
+        if not result.rowcount:
+            db.session.rollback()
+            return False
+        commit_changes('movies', 'actors')
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+# ---------------------------------------------------------
+# Validation.
+# ---------------------------------------------------------
+
+# Values accepted for Actor.gender.
+GENDERS = ('female', 'male', 'non-binary', 'other')
+MAX_AGE = 150
+
+
+# Returns: `value` if it is a non-empty string, else None.
+def parse_text(value):
+    if isinstance(value, str) and value.strip():
+        return value
+    return None
+
+
+# Returns: `value` as an age (int), or None if it is not one.
+def parse_age(value):
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and \
+            0 <= value <= MAX_AGE:
+        return value
+    return None
+
+
+# Returns: `value` as one of GENDERS, or None if it is not one.
+def parse_gender(value):
+    if isinstance(value, str) and value.strip().lower() in GENDERS:
+        return value.strip().lower()
+    return None
+
+
+# Returns: `value` as a date, or None if it is not one. Takes ISO 8601
+# dates (YYYY-MM-DD) and the HTTP dates older API responses used.
+def parse_date(value):
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        return None
+    try:
+        return date.fromisoformat(value.strip())
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).date()
+    except (TypeError, ValueError):
+        return None
+
+
+# Normalizes the `fields` of `data` with `parsers`, which return None
+# for invalid values. Missing and empty values are skipped.
+# Returns: values (dictionary) and invalid field names (list)
+def clean_values(data, fields, parsers):
+    values = {}
+    invalid = []
+    for field in fields:
+        value = data.get(field)
+        if value is None or value == '':
+            continue
+        value = parsers[field](value)
+        if value is None:
+            invalid.append(field)
+        else:
+            values[field] = value
+    return values, invalid
 
 # ---------------------------------------------------------
 # Models.
 # ---------------------------------------------------------
 
 
+# Full-text search document of a row: a Postgres tsvector, kept current
+# by a trigger (see the migrations), and an unused text column elsewhere.
+# Deferred so that loading rows never reads it.
+def search_vector_column():
+    return db.deferred(db.Column(
+        TSVECTOR().with_variant(db.Text(), 'sqlite')))
+
+
+# Cast of the movies: which actors play in which movie.
+movie_cast = db.Table(
+    'movie_cast',
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True, index=True)
+)
+
+
 # Creating the debatase for Actors
 class Actor(db.Model):
     __tablename__ = 'actors'
 
+    # Fields clients may select with ?fields=
+    FIELDS = ('id', 'name', 'age', 'gender', 'version')
+    # Fields a new actor must have.
+    REQUIRED_FIELDS = ('name', 'age', 'gender')
+    # Query parameters clients may filter by: (field, operator, parser).
+    FILTERS = {
+        'name_prefix': ('name', 'prefix', parse_text),
+        'min_age': ('age', '>=', parse_age),
+        'max_age': ('age', '<=', parse_age),
+        'gender': ('gender', '==', parse_gender)
+    }
+    # Fields clients may sort by with ?sort=, each backed by an index.
+    SORTS = ('id', 'name')
+    # Relationships clients may embed with ?include=
+    INCLUDES = ('movies',)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    age = db.Column(db.String)
+    age = db.Column(db.Integer)
     gender = db.Column(db.String)
+    updated_at = db.Column(
+        db.DateTime, nullable=False,
+        default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Incremented by every update, for If-Match.
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+    # Words of the name, for /search.
+    search_vector = search_vector_column()
 
     def __repr__(self):
         return f"<Actor id='{self.id}' name='{self.name}'>"
 
+    __table_args__ = (
+        db.CheckConstraint(
+            'gender IN ({})'.format(', '.join(
+                f"'{gender}'" for gender in GENDERS)),
+            name='ck_actors_gender'),
+    )
+
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    # Validates the writable fields of a request body.
+    # Returns: values (dictionary) and invalid field names (list)
+    @classmethod
+    def clean(cls, data):
+        return clean_values(data, cls.REQUIRED_FIELDS, {
+            'name': parse_text,
+            'age': parse_age,
+            'gender': parse_gender
+        })
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_changes(self.__tablename__)
 
     def update(self):
-        db.session.commit()
+        self.version = type(self).version + 1
+        commit_changes(*linked_tables(type(self)))
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_changes(*linked_tables(type(self)))
 
     def format(self):
         return{
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender
+            'gender': self.gender,
+            'version': self.version
         }
 
 
@@ -79,9 +553,35 @@ class Actor(db.Model):
 class Movie(db.Model):
     __tablename__ = 'movies'
 
+    # Fields clients may select with ?fields=
+    FIELDS = ('id', 'title', 'release', 'version')
+    # Fields a new movie must have.
+    REQUIRED_FIELDS = ('title', 'release')
+    # Query parameters clients may filter by: (field, operator, parser).
+    FILTERS = {
+        'title_prefix': ('title', 'prefix', parse_text),
+        'released_after': ('release', '>=', parse_date),
+        'released_before': ('release', '<=', parse_date)
+    }
+    # Fields clients may sort by with ?sort=, each backed by an index.
+    SORTS = ('id', 'title', 'release')
+    # Relationships clients may embed with ?include=
+    INCLUDES = ('cast',)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
     release = db.Column(db.Date)
+    updated_at = db.Column(
+        db.DateTime, nullable=False,
+        default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Incremented by every update, for If-Match.
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+    # Words of the title, for /search.
+    search_vector = search_vector_column()
+    cast = db.relationship(
+        'Actor', secondary=movie_cast, order_by='Actor.id',
+        backref=db.backref('movies', order_by='Movie.id'))
 
     def __repr__(self):
         return f"<Movie id='{self.id}' title='{self.title}'>"
@@ -90,20 +590,74 @@ class Movie(db.Model):
         self.title = title
         self.release = release
 
+    # Validates the writable fields of a request body.
+    # Returns: values (dictionary) and invalid field names (list)
+    @classmethod
+    def clean(cls, data):
+        return clean_values(data, cls.REQUIRED_FIELDS, {
+            'title': parse_text,
+            'release': parse_date
+        })
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_changes(self.__tablename__)
 
     def update(self):
-        db.session.commit()
+        self.version = type(self).version + 1
+        commit_changes(*linked_tables(type(self)))
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_changes(*linked_tables(type(self)))
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
             'release': self.release,
-        }
\ No newline at end of file
+            'version': self.version
+        }
+
+
+# B-tree indexes for sorting (id breaks ties for keyset pagination) and
+# lower() indexes for case-insensitive prefix search. text_pattern_ops
+# lets Postgres use them for LIKE 'prefix%' under any collation.
+db.Index('ix_actors_name_id', Actor.name, Actor.id)
+db.Index('ix_actors_name_lower',
+         db.func.lower(Actor.name).label('name_lower'),
+         postgresql_ops={'name_lower': 'text_pattern_ops'})
+db.Index('ix_movies_title_id', Movie.title, Movie.id)
+db.Index('ix_movies_title_lower',
+         db.func.lower(Movie.title).label('title_lower'),
+         postgresql_ops={'title_lower': 'text_pattern_ops'})
+db.Index('ix_movies_release_id', Movie.release, Movie.id)
+db.Index('ix_actors_search_vector', Actor.search_vector,
+         postgresql_using='gin')
+db.Index('ix_movies_search_vector', Movie.search_vector,
+         postgresql_using='gin')
+
+# Postgres trigger filling search_vector from the searched column on
+# every insert and every update of that column.
+SEARCH_TRIGGER = """
+    CREATE TRIGGER {table}_search_vector
+    BEFORE INSERT OR UPDATE OF {column} ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(search_vector, 'pg_catalog.simple', {column})
+"""
+for model, column in ((Actor, 'name'), (Movie, 'title')):
+    event.listen(model.__table__, 'after_create', DDL(
+        SEARCH_TRIGGER.format(table=model.__tablename__, column=column)
+    ).execute_if(dialect='postgresql'))
+
+
+# Version counter of each table, bumped by every write to it.
+# Conditional GETs and cached responses are keyed on these versions.
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<TableVersion name='{self.name}' version='{self.version}'>"
@@ -0,0 +1,186 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import base64
+import binascii
+import json
+from datetime import date
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+# ---------------------------------------------------------
+# Cursors
+# ---------------------------------------------------------
+
+
+# Encodes the keyset position of the last row of a page.
+# Accepts: values (list)
+# Returns: cursor (string)
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+# Decodes a cursor made by encode_cursor(), aborting with 422 if invalid.
+# Accepts: cursor (string)
+# Returns: values (list)
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(422)
+
+    if not isinstance(values, list) or not values:
+        abort(422)
+    return values
+
+# ---------------------------------------------------------
+# Pagination
+# ---------------------------------------------------------
+
+
+# Reads the "limit" query parameter.
+# A missing limit falls back to DEFAULT_PAGE_SIZE and a larger one than
+# MAX_PAGE_SIZE is capped to it.
+# Returns: limit (int)
+def get_limit_arg():
+    default_limit = current_app.config.get('DEFAULT_PAGE_SIZE', 50)
+    max_limit = current_app.config.get('MAX_PAGE_SIZE', 200)
+
+    limit = request.args.get('limit', default_limit)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        abort(422)
+    if limit < 1:
+        abort(422)
+    return min(limit, max_limit)
+
+
+# Reads the "limit" and "cursor" query parameters.
+# Returns: limit (int) and cursor values (list or None)
+def get_page_args():
+    limit = get_limit_arg()
+    cursor = request.args.get('cursor')
+    cursor = decode_cursor(cursor) if cursor else None
+    return limit, cursor
+
+
+# Reads the "sort" query parameter: a field of model.SORTS, prefixed
+# with "-" for descending order. Aborts with 422 for any other field.
+# Returns: field name and descending (bool), ('id', False) when not given
+def get_sort_arg(model):
+    sort = request.args.get('sort') or 'id'
+    descending = sort.startswith('-')
+    field = sort[1:] if descending else sort
+    if field not in model.SORTS:
+        abort(422)
+    return field, descending
+
+
+# Returns: the columns a listing sorted by `field` is ordered by, the
+# field itself followed by the id that breaks ties.
+def sort_columns(model, field):
+    if field == 'id':
+        return (model.id,)
+    return (getattr(model, field), model.id)
+
+
+# Orders `query` by `sort` as returned by get_sort_arg().
+# Rows without a value for the sort field come last, or first in
+# descending order, so that the order is the exact reverse and matches a
+# backward scan of the (field, id) index on Postgres.
+# Returns: Query
+def sort_query(query, model, sort):
+    field, descending = sort
+    columns = sort_columns(model, field)
+    order = [column.desc() if descending else column.asc()
+             for column in columns]
+    if field != 'id':
+        order[0] = order[0].nullsfirst() if descending else \
+            order[0].nullslast()
+    return query.order_by(*order)
+
+
+# Converts a value of a cursor back to the type of `column`; None stays
+# None for nullable columns. Aborts with 422 if it does not fit.
+def cursor_value(column, value):
+    if value is None and column.nullable:
+        return None
+    python_type = column.type.python_type
+    if python_type is date:
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            abort(422)
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        abort(422)
+    return value
+
+
+# Splits the rows of a listing sorted by `columns` into the segments of
+# sort_query() order: with a nullable field, the rows with a value,
+# ordered by (field, id), and the rows without one, ordered by id. Each
+# segment is a range of the (field, id) index, which a single query with
+# "OR field IS NULL" would scan from the start instead.
+# Returns: list of (condition or None, order columns)
+def keyset_segments(columns, descending):
+    if len(columns) == 1:
+        return [(None, columns)]
+    field, row_id = columns
+    segments = [(field.isnot(None), columns), (field.is_(None), (row_id,))]
+    return segments[::-1] if descending else segments
+
+
+# Fetches one page of `query` in `sort` order, continuing after the row
+# encoded in `cursor`. The position is compared as a row value, e.g.
+# (name, id) > (:name, :id), which is a single index range scan. When the
+# rows with a name run out before the page is full, the page is filled
+# with a second range query over the rows without one.
+# One extra row is read to know whether another page follows.
+# Returns: rows (list) and next_cursor (string or None)
+def paginate(query, model, limit, cursor=None, sort=('id', False)):
+    field, descending = sort
+    columns = sort_columns(model, field)
+    segments = keyset_segments(columns, descending)
+
+    bound = None
+    if cursor is not None:
+        if len(cursor) != len(columns):
+            abort(422)
+        bound = [cursor_value(column, value)
+                 for column, value in zip(columns, cursor)]
+        # Continues in the segment of the cursor row: the rows without a
+        # value come last, or first in descending order.
+        if len(segments) > 1 and bound[0] is None:
+            segments = segments if descending else segments[1:]
+            bound = bound[1:]
+        elif len(segments) > 1 and descending:
+            segments = segments[1:]
+
+    rows = []
+    for condition, order in segments:
+        segment = query if condition is None else query.filter(condition)
+        if bound is not None:
+            position = order[0] if len(order) == 1 else tuple_(*order)
+            value = bound[0] if len(bound) == 1 else tuple_(*bound)
+            segment = segment.filter(
+                position < value if descending else position > value)
+            bound = None
+        rows.extend(segment.order_by(
+            *[column.desc() if descending else column for column in order]
+        ).limit(limit + 1 - len(rows)).all())
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([
+            value.isoformat() if isinstance(value, date) else value
+            for value in (getattr(last, column.key) for column in columns)])
+
+    return rows, next_cursor
@@ -0,0 +1,288 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from flask import current_app, request, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ---------------------------------------------------------
+# Request profiler
+#
+# Profiles one request in PROFILE_SAMPLE_RATE from its start, and any
+# request running longer than PROFILE_SLOW_SECONDS from that point on.
+# A watchdog thread samples the stacks of the selected requests every
+# PROFILE_INTERVAL seconds with sys._current_frames(), so unselected
+# requests only pay for a dictionary insert and removal. The SQL
+# statements of every candidate request are kept until it ends, since a
+# request is only known to be slow once it already ran some of them.
+# Profiles are written as JSON to PROFILE_DIR, which keeps the latest
+# PROFILE_MAX_FILES of them.
+# ---------------------------------------------------------
+
+# Frames kept per sampled stack and statements kept per request.
+MAX_STACK_DEPTH = 100
+MAX_STATEMENTS = 1000
+
+PROFILE_ID = re.compile(r'^[0-9]+-[0-9]+-[0-9]+$')
+
+
+# Profile of one running request.
+class RequestProfile:
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.statements = []
+        self.dropped_statements = 0
+        self.status = None
+
+    # True if the request must be sampled at `now` (perf_counter).
+    def is_selected(self, now, slow_seconds):
+        return self.sampled or \
+            (slow_seconds and now - self.started >= slow_seconds)
+
+
+# Formats the stack of `frame` as "file:function;...", outermost first,
+# the collapsed format of flame graph tools.
+def collapse_stack(frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append('{}:{}'.format(
+            os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Selects, samples and stores the profiles of the requests of one app.
+class Profiler:
+    def __init__(self, directory, sample_rate=0, slow_seconds=0,
+                 interval=0.005, max_files=100):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.max_files = max_files
+        self._counter = itertools.count()
+        self._ids = itertools.count()
+        # thread id -> RequestProfile of the request it runs
+        self._active = {}
+        self._write_lock = threading.Lock()
+        self._watchdog = None
+
+    def start_watchdog(self):
+        self._watchdog = threading.Thread(
+            target=self._sample_forever, name='profiler', daemon=True)
+        self._watchdog.start()
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    # Records the current stack of every selected request.
+    def sample(self):
+        if not self._active:
+            return
+        now = time.perf_counter()
+        selected = [profile for profile in list(self._active.values())
+                    if profile.is_selected(now, self.slow_seconds)]
+        if not selected:
+            return
+
+        frames = sys._current_frames()
+        for profile in selected:
+            frame = frames.get(profile.thread_id)
+            if frame is not None:
+                profile.stacks[collapse_stack(frame)] += 1
+                profile.samples += 1
+
+    # Registers the request of the calling thread.
+    # Returns: RequestProfile, or None if it cannot be selected
+    def start(self):
+        sampled = self.sample_rate > 0 and \
+            next(self._counter) % self.sample_rate == 0
+        if not sampled and not self.slow_seconds:
+            return None
+        profile = RequestProfile(sampled)
+        self._active[profile.thread_id] = profile
+        return profile
+
+    # Unregisters `profile` and writes it if it was selected.
+    # Returns: the id of the written profile, or None
+    def finish(self, profile, details):
+        self._active.pop(profile.thread_id, None)
+        duration = time.perf_counter() - profile.started
+        if not profile.sampled and duration < self.slow_seconds:
+            return None
+
+        document = dict(
+            details,
+            reason='sampled' if profile.sampled else 'slow',
+            started_at=profile.started_at,
+            duration=duration,
+            status=profile.status,
+            interval=self.interval,
+            samples=profile.samples,
+            stacks=dict(profile.stacks.most_common()),
+            statements=[{'statement': statement, 'seconds': seconds}
+                        for statement, _, seconds in profile.statements],
+            dropped_statements=profile.dropped_statements)
+        return self.write(document)
+
+    # Writes `document` to the ring buffer, then removes the oldest
+    # profiles beyond max_files. Ids sort by creation time.
+    # Returns: profile id (string)
+    def write(self, document):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._write_lock:
+            profile_id = '{}-{}-{}'.format(
+                time.time_ns(), os.getpid(), next(self._ids))
+            document['id'] = profile_id
+            path = os.path.join(self.directory, profile_id + '.json')
+            with open(path + '.tmp', 'w') as profile_file:
+                json.dump(document, profile_file)
+            os.replace(path + '.tmp', path)
+
+            for old_id in list_profile_ids(self.directory)[self.max_files:]:
+                try:
+                    os.remove(os.path.join(self.directory, old_id + '.json'))
+                except FileNotFoundError:
+                    pass
+        return profile_id
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    profile = getattr(_request_ctx_stack.top, 'request_profile', None)
+    if profile is None:
+        return
+    if len(profile.statements) >= MAX_STATEMENTS:
+        profile.dropped_statements += 1
+    else:
+        profile.statements.append([statement, time.perf_counter(), None])
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context,
+                  executemany):
+    profile = getattr(_request_ctx_stack.top, 'request_profile', None)
+    if profile is not None and profile.statements and \
+            profile.statements[-1][0] is statement:
+        entry = profile.statements[-1]
+        entry[2] = time.perf_counter() - entry[1]
+
+
+# Decorator for endpoints that are never profiled, e.g. the ones reading
+# the profiles, so that they do not push the others out of the buffer.
+def not_profiled(f):
+    f.profiled = False
+    return f
+
+
+def start_request():
+    view = current_app.view_functions.get(request.endpoint)
+    if getattr(view, 'profiled', True):
+        profiler = current_app.extensions['profiler']
+        _request_ctx_stack.top.request_profile = profiler.start()
+
+
+def record_status(response):
+    profile = getattr(_request_ctx_stack.top, 'request_profile', None)
+    if profile is not None:
+        profile.status = response.status_code
+    return response
+
+
+# Runs after every request, including failed ones, so the profile is
+# always unregistered.
+def end_request(error=None):
+    profile = getattr(_request_ctx_stack.top, 'request_profile', None)
+    if profile is None:
+        return
+    rule = request.url_rule
+    current_app.extensions['profiler'].finish(profile, {
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'route': rule.rule if rule else None,
+        'error': repr(error) if error is not None else None
+    })
+
+
+# Sets up the profiler of `app` from PROFILE_SAMPLE_RATE and
+# PROFILE_SLOW_SECONDS; it stays off while both are 0.
+# Returns: Profiler, or None
+def init_profiler(app):
+    config = app.config
+    sample_rate = config.get('PROFILE_SAMPLE_RATE', 0)
+    slow_seconds = config.get('PROFILE_SLOW_SECONDS', 0)
+    if not sample_rate and not slow_seconds:
+        app.extensions['profiler'] = None
+        return None
+
+    profiler = app.extensions['profiler'] = Profiler(
+        config['PROFILE_DIR'], sample_rate, slow_seconds,
+        config.get('PROFILE_INTERVAL', 0.005),
+        config.get('PROFILE_MAX_FILES', 100))
+    profiler.start_watchdog()
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(end_request)
+    return profiler
+
+# ---------------------------------------------------------
+# Stored profiles
+# ---------------------------------------------------------
+
+
+# Returns: the ids of the profiles in `directory`, newest first
+def list_profile_ids(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    ids = [name[:-len('.json')] for name in names if name.endswith('.json')]
+    ids = [profile_id for profile_id in ids if PROFILE_ID.match(profile_id)]
+    return sorted(ids, key=lambda profile_id: [
+        int(part) for part in profile_id.split('-')], reverse=True)
+
+
+# Reads the profile `profile_id` of the current app.
+# Returns: profile (dictionary), or None if there is no such profile
+def read_profile(profile_id):
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(current_app.config['PROFILE_DIR'],
+                        profile_id + '.json')
+    try:
+        with open(path) as profile_file:
+            return json.load(profile_file)
+    except FileNotFoundError:
+        return None
+
+
+# Returns: a summary of every stored profile, newest first (list)
+def list_profiles():
+    summaries = []
+    for profile_id in list_profile_ids(current_app.config['PROFILE_DIR']):
+        profile = read_profile(profile_id)
+        if profile is not None:
+            summaries.append({
+                key: profile.get(key) for key in (
+                    'id', 'reason', 'method', 'path', 'status',
+                    'started_at', 'duration', 'samples')
+            })
+    return summaries
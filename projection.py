@@ -0,0 +1,120 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from functools import wraps
+from operator import itemgetter
+from flask import abort, request
+from auth import check_permissions, get_current_token
+from models import db
+
+# ---------------------------------------------------------
+# Field projection
+# ---------------------------------------------------------
+
+
+# Reads the comma separated query parameter `name`.
+# Every value must be listed in `allowed`, otherwise aborts with 422.
+# Returns: values (tuple), None when not given
+def get_list_arg(name, allowed):
+    arg = request.args.get(name)
+    if not arg:
+        return None
+
+    values = []
+    for value in arg.split(','):
+        value = value.strip()
+        if value not in allowed:
+            abort(422)
+        if value not in values:
+            values.append(value)
+    return tuple(values)
+
+
+# Reads the "fields" query parameter, checked against model.FIELDS.
+# Returns: field names (tuple), all of model.FIELDS when not given
+def get_fields_arg(model):
+    return get_list_arg('fields', model.FIELDS) or model.FIELDS
+
+
+# Reads the "include" query parameter, checked against model.INCLUDES.
+# Returns: relationship names (tuple), empty when not given
+def get_include_arg(model):
+    return get_list_arg('include', model.INCLUDES) or ()
+
+
+# Decorator for endpoints of `model` accepting "include". Embedding the
+# rows of another table also needs the permission to read that table; it
+# is checked before conditional() may answer from an ETag or the response
+# cache. Must be applied between requires_auth() and conditional().
+def checks_includes(model):
+    def checks_includes_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            for name in get_include_arg(model):
+                target = getattr(model, name).property.mapper.class_
+                check_permissions(f'get:{target.__tablename__}',
+                                  get_current_token())
+            return f(*args, **kwargs)
+
+        return wrapper
+    return checks_includes_decorator
+
+
+# Builds a query that selects only the columns of `fields`, plus the id
+# and `extra` fields needed for pagination, instead of loading whole
+# model instances.
+# Returns: Query of row tuples
+def select_fields(model, fields, extra=()):
+    names = fields if 'id' in fields else ('id',) + fields
+    names += tuple(name for name in extra if name not in names)
+    return model.query.with_entities(
+        *[getattr(model, name) for name in names])
+
+
+# Loads the `includes` relationships of the `rows` of `model` with one
+# query per relationship, however many rows there are, like selectinload.
+# Returns: relationship name -> row id -> related rows (list of dictionaries)
+def load_includes(model, rows, includes):
+    ids = [row.id for row in rows]
+    loaded = {}
+    for name in includes:
+        relationship = getattr(model, name).property
+        target = relationship.mapper.class_
+        (_, owner_column), = relationship.synchronize_pairs
+        (_, target_column), = relationship.secondary_synchronize_pairs
+
+        related = db.session.query(
+            owner_column,
+            *[getattr(target, field) for field in target.FIELDS]).select_from(
+            relationship.secondary).join(
+            target, target.id == target_column).filter(
+            owner_column.in_(ids)).order_by(owner_column, target.id)
+
+        groups = {row_id: [] for row_id in ids}
+        for row in related:
+            groups[row[0]].append(dict(zip(target.FIELDS, row[1:])))
+        loaded[name] = groups
+    return loaded
+
+
+# Builds the function serializing the rows of `query`, made by
+# select_fields(), with just the requested fields and their related rows
+# from load_includes(). Values are read by position from the row tuples
+# rather than by attribute, which matters on pages of thousands of rows.
+# Returns: callable taking a row and returning a dictionary
+def row_formatter(query, fields, included=None):
+    names = [column['name'] for column in query.column_descriptions]
+    get_values = itemgetter(*[names.index(field) for field in fields])
+    single = len(fields) == 1
+    id_position = names.index('id')
+    included = included or {}
+
+    def format_row(row):
+        values = get_values(row)
+        values = dict(zip(fields, (values,) if single else values))
+        for name, groups in included.items():
+            values[name] = groups[row[id_position]]
+        return values
+
+    return format_row
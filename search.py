@@ -0,0 +1,183 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import bisect
+import re
+import threading
+from collections import defaultdict
+from flask import abort, current_app, request
+from sqlalchemy import func
+from sqlalchemy.engine.url import make_url
+from models import Actor, Movie, db, get_table_versions
+
+# ---------------------------------------------------------
+# Search documents
+# ---------------------------------------------------------
+
+# Searchable rows: (result type, model, searched field).
+DOCUMENTS = (
+    ('actor', Actor, 'name'),
+    ('movie', Movie, 'title')
+)
+TABLES = ('actors', 'movies')
+
+
+# Splits `text` into lower case words.
+# Returns: words (list)
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+# Reads the "q" query parameter, aborting with 422 if it has no words.
+# Returns: words (list)
+def get_search_terms():
+    terms = tokenize(request.args.get('q'))
+    if not terms:
+        abort(422)
+    return terms
+
+
+# Orders results by descending rank, then by type and id.
+# Returns: the first `limit` results (list)
+def rank_results(results, limit):
+    results.sort(key=lambda result: (-result['rank'], result['type'],
+                                     result['id']))
+    return results[:limit]
+
+# ---------------------------------------------------------
+# Search backends
+# ---------------------------------------------------------
+
+
+# Interface of search backends.
+# search(terms, limit) returns the best `limit` rows containing every
+# term, the last one also as a prefix, as dictionaries with the type,
+# id, searched field and rank.
+class SearchBackend:
+    def search(self, terms, limit):
+        raise NotImplementedError
+
+
+# Searches the search_vector columns with their GIN indexes.
+class PostgresSearch(SearchBackend):
+    def search(self, terms, limit):
+        query = func.to_tsquery('pg_catalog.simple', ' & '.join(
+            terms[:-1] + [terms[-1] + ':*']))
+
+        results = []
+        for kind, model, field in DOCUMENTS:
+            rank = func.ts_rank(model.search_vector, query)
+            rows = db.session.query(
+                model.id, getattr(model, field), rank.label('rank')).filter(
+                model.search_vector.op('@@')(query)).order_by(
+                rank.desc(), model.id).limit(limit)
+            results.extend(
+                {'type': kind, 'id': row[0], field: row[1],
+                 'rank': float(row[2])}
+                for row in rows)
+        return rank_results(results, limit)
+
+
+# One build of the InvertedIndex; never changed once built.
+class IndexSnapshot:
+    def __init__(self, postings, words, documents):
+        # word -> set of (type, id)
+        self.postings = postings
+        # sorted words, for prefix lookups
+        self.words = words
+        # (type, id) -> (field, text, number of words)
+        self.documents = documents
+
+    # Returns: (type, id) -> score of the documents matching `term`;
+    # whole words score 1 and words starting with `term` 0.5.
+    def match(self, term, prefix):
+        scores = dict.fromkeys(self.postings.get(term, ()), 1.0)
+        if prefix:
+            start = bisect.bisect_right(self.words, term)
+            for word in self.words[start:]:
+                if not word.startswith(term):
+                    break
+                for key in self.postings[word]:
+                    scores.setdefault(key, 0.5)
+        return scores
+
+
+# In-memory inverted index over every actor name and movie title, for
+# tests and local runs without Postgres.
+# It is rebuilt from the database whenever the table versions changed
+# since the last build, so writes of other processes are seen too.
+# Each build makes a new IndexSnapshot, so searches running during a
+# rebuild keep reading a consistent one.
+class InvertedIndex(SearchBackend):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = None
+        self.snapshot = IndexSnapshot({}, [], {})
+
+    # Reads every actor name and movie title.
+    # Returns: IndexSnapshot
+    def build(self):
+        postings = defaultdict(set)
+        documents = {}
+        for kind, model, field in DOCUMENTS:
+            rows = db.session.query(model.id, getattr(model, field))
+            for row_id, text in rows.yield_per(1000):
+                words = tokenize(text)
+                if not words:
+                    continue
+                documents[(kind, row_id)] = (field, text, len(words))
+                for word in words:
+                    postings[word].add((kind, row_id))
+
+        return IndexSnapshot(dict(postings), sorted(postings), documents)
+
+    # Rebuilds the index if the tables changed.
+    # Returns: the current IndexSnapshot
+    def refresh(self):
+        versions = get_table_versions(TABLES)
+        with self.lock:
+            if versions != self.versions:
+                self.snapshot = self.build()
+                self.versions = versions
+            return self.snapshot
+
+    def search(self, terms, limit):
+        snapshot = self.refresh()
+
+        matches = None
+        for i, term in enumerate(terms):
+            scores = snapshot.match(term, prefix=i == len(terms) - 1)
+            if matches is None:
+                matches = scores
+            else:
+                matches = {key: matches[key] + score
+                           for key, score in scores.items()
+                           if key in matches}
+
+        results = []
+        for (kind, row_id), score in matches.items():
+            field, text, length = snapshot.documents[(kind, row_id)]
+            results.append({'type': kind, 'id': row_id, field: text,
+                            'rank': score / length})
+        return rank_results(results, limit)
+
+
+# Stores the search backend of `app` in app.extensions['search'].
+# Postgres databases use PostgresSearch, others the InvertedIndex.
+def init_search(app, backend=None):
+    if backend is None:
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() == 'postgresql':
+            backend = PostgresSearch()
+        else:
+            backend = InvertedIndex()
+
+    app.extensions['search'] = backend
+    return backend
+
+
+# Searches actors and movies with the backend of the current app.
+# Returns: results (list)
+def search(terms, limit):
+    return current_app.extensions['search'].search(terms, limit)
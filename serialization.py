@@ -0,0 +1,90 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import json
+import time
+from datetime import date
+from flask import current_app
+from flask.json import JSONEncoder
+from metrics import record_phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ---------------------------------------------------------
+# JSON encoders
+# ---------------------------------------------------------
+
+
+# Encoder of jsonify() writing dates as ISO 8601 (YYYY-MM-DD), like the
+# fast encoders below, instead of Flask's default HTTP dates.
+class ISODateJSONEncoder(JSONEncoder):
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+
+# Converts the values the json module cannot encode.
+def encode_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+# Encodes `data` with orjson, which writes dates as ISO 8601 itself.
+# Returns: bytes
+def dumps_orjson(data):
+    return orjson.dumps(data)
+
+
+# Encodes `data` with the json module, compactly and with ISO dates.
+# Returns: bytes
+def dumps_stdlib(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False,
+                      default=encode_default).encode('utf-8')
+
+
+# Encoders selectable with the JSON_SERIALIZER config.
+SERIALIZERS = {
+    'orjson': dumps_orjson,
+    'stdlib': dumps_stdlib
+}
+
+
+# Stores the encoder named by JSON_SERIALIZER in
+# app.extensions['serializer']. "auto", the default, picks orjson when it
+# is installed and the json module otherwise.
+# Returns: encoder (callable)
+def init_serializer(app):
+    name = app.config.get('JSON_SERIALIZER', 'auto')
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name not in SERIALIZERS:
+        raise ValueError(f'Unknown JSON_SERIALIZER: {name!r}')
+    if name == 'orjson' and orjson is None:
+        raise ValueError('JSON_SERIALIZER is orjson but it is not installed')
+
+    app.json_encoder = ISODateJSONEncoder
+    app.extensions['serializer'] = SERIALIZERS[name]
+    return SERIALIZERS[name]
+
+
+# Encodes `data` with the encoder of the current app.
+# Returns: bytes
+def dumps(data):
+    started = time.perf_counter()
+    body = current_app.extensions['serializer'](data)
+    record_phase('serialize', time.perf_counter() - started)
+    return body
+
+
+# Builds a JSON response with the encoder of the current app, for the
+# large payloads where jsonify() is the bottleneck.
+# Returns: Response
+def json_response(data):
+    return current_app.response_class(dumps(data),
+                                      mimetype='application/json')
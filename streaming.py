@@ -0,0 +1,52 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from flask import Response, current_app, request, stream_with_context
+from serialization import dumps
+
+# ---------------------------------------------------------
+# Streaming exports
+# ---------------------------------------------------------
+
+
+# Checks whether the request asks for the whole table as a stream.
+# Returns: boolean
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+# Streams every row of `query` as one JSON document or as NDJSON.
+# Rows are read from a server-side cursor in batches of STREAM_BATCH_SIZE
+# and each batch is written as one chunk, so memory use does not grow
+# with the size of the table.
+# Accepts: query (Query), key (string) and format_row (callable)
+# Returns: Response
+def stream_query(query, key, format_row):
+    batch_size = current_app.config.get('STREAM_BATCH_SIZE', 1000)
+    rows = query.execution_options(stream_results=True).yield_per(batch_size)
+    ndjson = request.args.get('format') == 'ndjson'
+
+    def generate():
+        if not ndjson:
+            yield b'{"success":true,"%s":[' % key.encode('utf-8')
+
+        batch = []
+        separator = b''
+        for row in rows:
+            if ndjson:
+                batch.append(dumps(format_row(row)) + b'\n')
+            else:
+                batch.append(separator + dumps(format_row(row)))
+                separator = b','
+            if len(batch) >= batch_size:
+                yield b''.join(batch)
+                batch = []
+        if batch:
+            yield b''.join(batch)
+
+        if not ndjson:
+            yield b']}'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
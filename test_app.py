@@ -2,29 +2,98 @@
 # Imports
 # ---------------------------------------------------------
 
+import asyncio
+import gzip
 import json
 import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from flask import url_for
-from flask_sqlalchemy import SQLAlchemy
+import zlib
+from unittest import mock
+from flask import Flask, Response, url_for
+import compression
 from app import create_app
-from models import setup_db, Actor, Movie
-from config import bearer_tokens
+from asgi import MAX_PENDING_CHUNKS, ASGIAdapter
+from caching import CacheBackend, CachedResponse, LRUCache, init_cache
+from idempotency import (
+    MemoryIdempotencyStore, StoredResponse, init_idempotency,
+    request_fingerprint
+)
+from metrics import Histogram
+from profiler import Profiler, init_profiler, list_profile_ids
+from search import InvertedIndex
+from serialization import SERIALIZERS, dumps_orjson, init_serializer, orjson
+from auth import (
+    ANY_OF, AuthError, JWKSCache, TokenCache, check_permissions,
+    compile_payload, get_json_data, get_verified_token, jwks_cache
+)
+from local_jwt import LocalIssuer
+from models import db, Actor, Movie
+from models import TimedQueuePool, engine_options, pool_metrics
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import StaticPool
 from datetime import date
 
+# Every app of the tests uses this one in-memory database. Autocommit
+# mode (isolation_level=None) leaves BEGIN and SAVEPOINT to SQLAlchemy,
+# see begin_transaction().
+memory_database = sqlite3.connect(
+    ':memory:', check_same_thread=False, isolation_level=None)
+
+TEST_CONFIG = {
+    'TESTING': True,
+    'DEBUG': False,
+    'METRICS_ENABLED': True,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        'creator': lambda: memory_database,
+        'poolclass': StaticPool
+    }
+}
+
+with create_app(TEST_CONFIG).app_context():
+    db.create_all()
+
+# Tokens are signed with a local key, whose JWKS replaces the one of Auth0.
+issuer = LocalIssuer()
+jwks_cache.url = issuer.write_jwks(
+    os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+
 # Create dict with Authorization key and Bearer token as values. 
 
-casting_assistant_auth_header = {
-    'Authorization': bearer_tokens['casting_assistant']
-}
+casting_assistant_auth_header = issuer.auth_header([
+    'get:actors', 'get:movies'
+], subject='local|casting_assistant')
 
-casting_director_auth_header = {
-    'Authorization': bearer_tokens['casting_director']
-}
+casting_director_auth_header = issuer.auth_header([
+    'get:actors', 'get:movies', 'post:actors', 'patch:actor', 'patch:movie',
+    'delete:actor'
+], subject='local|casting_director')
 
-executive_producer_auth_header = {
-    'Authorization': bearer_tokens['executive_producer']
-}
+executive_producer_auth_header = issuer.auth_header([
+    'get:actors', 'get:movies', 'post:actors', 'post:movies', 'patch:actor',
+    'patch:movie', 'delete:actor', 'delete:movie'
+], subject='local|executive_producer')
+
+monitoring_auth_header = issuer.auth_header([
+    'get:metrics'
+], subject='local|monitoring')
+
+
+def begin_transaction(connection):
+    connection.execute('BEGIN')
+
+
+# Starts a new SAVEPOINT once the test's one ends with a commit or a
+# rollback, so that the session never ends the enclosing transaction.
+def restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
 
 # ---------------------------------------------------------
 # Tests
@@ -36,23 +105,32 @@ class AgencyTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app(TEST_CONFIG)
         self.client = self.app.test_client
-        self.database_name = "henana"
-        self.database_path = "postgresql://{}/{}".format('postgres:XXXXX@localhost:5432',
-                                                         self.database_name)
-        setup_db(self.app, self.database_path)
 
-        # binds the app to the current context
+        # Runs the test in a transaction rolled back by tearDown(). The
+        # commits of the app only release a SAVEPOINT, restarted after
+        # each commit or rollback.
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.drop_all()
-            self.db.create_all()
-    
+            engine = db.engine
+        event.listen(engine, 'begin', begin_transaction)
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        db.session = db.create_scoped_session(
+            {'bind': self.connection, 'binds': {}})
+        db.session.begin_nested()
+        # Keeps the session, and its SAVEPOINT, across requests.
+        db.session.remove = lambda: None
+        event.listen(db.session, 'after_transaction_end', restart_savepoint)
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        event.remove(db.session, 'after_transaction_end', restart_savepoint)
+        db.session.rollback()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
 
     def test_should_return_all_actors(self):
         # Insert dummy actor into database.
@@ -74,7 +152,7 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_should_return_all_movies(self):
         # Insert dummy actor into database.
-        movie = Movie(title="kimetu", release="June 30, 2006")
+        movie = Movie(title="kimetu", release=date(2006, 6, 30))
         movie.insert()
 
         res = self.client().get('/movies', headers = casting_assistant_auth_header )
@@ -95,8 +173,8 @@ class AgencyTestCase(unittest.TestCase):
 
         json_create_actor = {
             'name': "New actor name",
-            'age': "New actor age",
-            'gender': "New actor gender"
+            'age': 30,
+            'gender': "female"
         } 
 
         res = self.client().post('/add-actor',
@@ -140,6 +218,7 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_get_all_actors(self):
         """Test GET all actors."""
+        Actor(name="taro", age=13, gender="male").insert()
         res = self.client().get('/actors', headers = casting_assistant_auth_header)
         data = json.loads(res.data)
 
@@ -169,7 +248,7 @@ class AgencyTestCase(unittest.TestCase):
         actor_id = actor.id
         
         json_edit_actor_with_new_age = {
-            'age' : '30'
+            'age' : 30
         } 
         
         res = self.client().patch(
@@ -261,7 +340,7 @@ class AgencyTestCase(unittest.TestCase):
 
         json_create_movie = {
             'title' : 'Crisso Movie',
-            'release' : "Fri, 20 Mar 1998 00:00:00 GMT"
+            'release' : "1998-03-20"
         } 
 
         res = self.client().post('/add-movie', json = json_create_movie
@@ -297,6 +376,7 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_get_all_movies(self):
         """Test GET all movies."""
+        Movie(title="kimetu", release=date(2006, 6, 30)).insert()
         res = self.client().get('/movies', headers = casting_assistant_auth_header)
         data = json.loads(res.data)
 
@@ -321,12 +401,12 @@ class AgencyTestCase(unittest.TestCase):
     def test_edit_movie(self):
         """Test PATCH existing movies"""
         
-        movie = Movie(title="Invisible Man", release="March 20, 1998")
+        movie = Movie(title="Invisible Man", release=date(1998, 3, 20))
         movie.insert()
         movie_id= movie.id
 
         json_edit_movie = {
-            'release' : "Tue, 30 Jun 2009 00:00:00 GMT"
+            'release' : "2009-06-30"
         } 
         res = self.client().patch(
             f'/movies/{movie_id}',
@@ -385,7 +465,7 @@ class AgencyTestCase(unittest.TestCase):
     def test_delete_movie(self):
         """Test DELETE existing movie"""
 
-        movie = Movie(title="Invisible Man", release="March 20, 1998")
+        movie = Movie(title="Invisible Man", release=date(1998, 3, 20))
         movie.insert()
        # movie_id= movie.id
 
@@ -410,6 +490,1556 @@ class AgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'] , 'Item not found.')
 
+#----------------------------------------------------------------------------#
+# Tests for /actors and /movies pagination
+#----------------------------------------------------------------------------#
+
+    def test_actors_are_paginated_by_cursor(self):
+        """Test GET actors page by page."""
+        for name in ("ichiro", "jiro", "saburo"):
+            Actor(name=name, age=20, gender="male").insert()
+
+        ids = []
+        url = '/actors?limit=2'
+        while url:
+            res = self.client().get(url, headers = casting_assistant_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(len(data['actors']) <= 2)
+            ids.extend(actor['id'] for actor in data['actors'])
+            url = None
+            if data['next_cursor']:
+                url = f"/actors?limit=2&cursor={data['next_cursor']}"
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), Actor.query.count())
+
+    def test_movies_page_size_is_capped(self):
+        """Test GET movies with a limit above the maximum page size."""
+        movie = Movie(title="kimetu", release=date(2006, 6, 30))
+        movie.insert()
+
+        res = self.client().get('/movies?limit=100000',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['movies']) <= self.app.config['MAX_PAGE_SIZE'])
+
+    def test_error_422_invalid_page_args(self):
+        """Test GET actors with an invalid limit or cursor."""
+        for url in ('/actors?limit=0', '/actors?limit=ten', '/actors?cursor=@@'):
+            res = self.client().get(url, headers = casting_assistant_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertFalse(data['success'])
+
+#----------------------------------------------------------------------------#
+# Tests for /actors and /movies streaming exports
+#----------------------------------------------------------------------------#
+
+    def test_actors_are_streamed_as_json(self):
+        """Test GET all actors as a streamed JSON document."""
+        Actor(name="taro", age=13, gender="male").insert()
+
+        res = self.client().get('/actors?stream=1',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['actors']), Actor.query.count())
+
+    def test_movies_are_streamed_as_ndjson(self):
+        """Test GET all movies as a streamed NDJSON document."""
+        Movie(title="kimetu", release=date(2006, 6, 30)).insert()
+
+        res = self.client().get('/movies?stream=1&format=ndjson',
+                                headers = casting_assistant_auth_header)
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), Movie.query.count())
+        self.assertEqual(json.loads(lines[-1])['title'], "kimetu")
+
+#----------------------------------------------------------------------------#
+# Tests for field projection
+#----------------------------------------------------------------------------#
+
+    def test_actors_fields_are_projected(self):
+        """Test GET actors with only some fields."""
+        Actor(name="taro", age=13, gender="male").insert()
+
+        res = self.client().get('/actors?fields=name',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'name'})
+
+    def test_get_single_movie_fields(self):
+        """Test GET a single movie with only some fields."""
+        movie = Movie(title="kimetu", release=date(2006, 6, 30))
+        movie.insert()
+
+        res = self.client().get(f'/movies/{movie.id}?fields=id,title',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], {'id': movie.id, 'title': "kimetu"})
+
+    def test_error_422_unknown_field(self):
+        """Test GET actors with a field outside the whitelist."""
+        res = self.client().get('/actors?fields=name,password',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+#----------------------------------------------------------------------------#
+# Tests for /actors/bulk and /movies/bulk POST
+#----------------------------------------------------------------------------#
+
+    def test_bulk_create_actors(self):
+        """Test POST many actors at once."""
+        json_create_actors = [
+            {'name': "ichiro", 'age': 20, 'gender': "male"},
+            {'name': "hanako", 'age': 21, 'gender': "female"}
+        ]
+
+        res = self.client().post('/actors/bulk',
+                                 json = json_create_actors,
+                                 headers = casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['actor_ids']), 2)
+        self.assertEqual(Actor.query.get(data['actor_ids'][1]).name, "hanako")
+
+    def test_bulk_create_actors_from_ndjson(self):
+        """Test POST many actors as NDJSON."""
+        body = '\n'.join(json.dumps({'name': name, 'age': 30, 'gender': "male"})
+                         for name in ("jiro", "saburo"))
+
+        res = self.client().post('/actors/bulk',
+                                 data = body,
+                                 content_type = 'application/x-ndjson',
+                                 headers = casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actor_ids']), 2)
+
+    def test_error_422_bulk_create_movies(self):
+        """Test POST many movies with invalid items."""
+        count = Movie.query.count()
+        json_create_movies = [
+            {'title': "kimetu", 'release': "2006-06-30"},
+            {'title': "no release"},
+            "not a movie"
+        ]
+
+        res = self.client().post('/movies/bulk',
+                                 json = json_create_movies,
+                                 headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual([error['index'] for error in data['errors']], [1, 2])
+        self.assertEqual(data['errors'][0]['missing'], ['release'])
+        self.assertEqual(Movie.query.count(), count)
+
+#----------------------------------------------------------------------------#
+# Tests for /actors/bulk and /movies/bulk PATCH and DELETE
+#----------------------------------------------------------------------------#
+
+    def test_bulk_edit_actors_with_shared_changes(self):
+        """Test PATCH many actors with the same changes."""
+        actors = [Actor(name=name, age=20, gender="male")
+                  for name in ("ichiro", "jiro")]
+        for actor in actors:
+            actor.insert()
+        ids = [actor.id for actor in actors]
+
+        res = self.client().patch('/actors/bulk',
+                                  json = {'ids': ids + [987654],
+                                          'changes': {'age': 40}},
+                                  headers = casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor_ids'], ids)
+        self.assertEqual(data['not_found'], [987654])
+        for actor_id in ids:
+            self.assertEqual(Actor.query.get(actor_id).age, 40)
+
+    def test_bulk_edit_movies_per_id(self):
+        """Test PATCH many movies with different changes."""
+        movies = [Movie(title=title, release=date(2006, 6, 30))
+                  for title in ("kimetu", "totoro")]
+        for movie in movies:
+            movie.insert()
+        items = [{'id': movie.id, 'title': movie.title.upper()}
+                 for movie in movies]
+
+        res = self.client().patch('/movies/bulk',
+                                  json = {'items': items},
+                                  headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie_ids'], sorted(item['id'] for item in items))
+        self.assertEqual(Movie.query.get(items[1]['id']).title, "TOTORO")
+
+    def test_bulk_delete_actors(self):
+        """Test DELETE many actors."""
+        actor = Actor(name="unchi", age=5, gender="female")
+        actor.insert()
+        actor_id = actor.id
+
+        res = self.client().delete('/actors/bulk',
+                                   json = {'ids': [actor_id, 987654]},
+                                   headers = casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor_ids'], [actor_id])
+        self.assertEqual(data['not_found'], [987654])
+        self.assertIsNone(Actor.query.filter(Actor.id == actor_id).one_or_none())
+
+    def test_error_422_bulk_delete_movies(self):
+        """Test DELETE many movies without an id list."""
+        res = self.client().delete('/movies/bulk',
+                                   json = {'ids': "1,2"},
+                                   headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+#----------------------------------------------------------------------------#
+# Tests for conditional GET
+#----------------------------------------------------------------------------#
+
+    def test_unchanged_actors_are_not_modified(self):
+        """Test GET actors with the ETag of the previous response."""
+        Actor(name="taro", age=13, gender="male").insert()
+
+        res = self.client().get('/actors', headers = casting_assistant_auth_header)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/actors', headers = dict(
+            casting_assistant_auth_header, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_changed_movie_gets_new_etag(self):
+        """Test GET a movie again after it was updated."""
+        movie = Movie(title="kimetu", release=date(2006, 6, 30))
+        movie.insert()
+
+        res = self.client().get(f'/movies/{movie.id}',
+                                headers = casting_assistant_auth_header)
+        etag = res.headers['ETag']
+        updated_at = movie.updated_at
+
+        movie = Movie.query.get(movie.id)
+        movie.title = "kimetu no yaiba"
+        movie.update()
+
+        res = self.client().get(f'/movies/{movie.id}', headers = dict(
+            casting_assistant_auth_header, **{'If-None-Match': etag}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(data['movie']['title'], "kimetu no yaiba")
+        self.assertTrue(movie.updated_at >= updated_at)
+
+#----------------------------------------------------------------------------#
+# Tests for the response cache
+#----------------------------------------------------------------------------#
+
+    def test_actors_are_served_from_response_cache(self):
+        """Test GET actors twice with a fake cache backend."""
+        cache = FakeCache()
+        init_cache(self.app, cache)
+        Actor(name="taro", age=13, gender="male").insert()
+
+        first = self.client().get('/actors', headers = casting_assistant_auth_header)
+        second = self.client().get('/actors', headers = casting_assistant_auth_header)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(cache.hits, 1)
+
+        Actor(name="jiro", age=20, gender="male").insert()
+        self.assertIn('actors', cache.invalidated)
+        self.assertEqual(cache.values, {})
+
+    def test_response_cache_is_keyed_by_permissions(self):
+        """Test GET movies with two roles and a fake cache backend."""
+        cache = FakeCache()
+        init_cache(self.app, cache)
+        Movie(title="kimetu", release=date(2006, 6, 30)).insert()
+
+        self.client().get('/movies', headers = casting_assistant_auth_header)
+        self.client().get('/movies', headers = executive_producer_auth_header)
+
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(len(cache.values), 2)
+
+#----------------------------------------------------------------------------#
+# Tests for actor validation
+#----------------------------------------------------------------------------#
+
+    def test_actor_age_and_gender_are_normalized(self):
+        """Test POST new actor with an age string and a capitalized gender."""
+        res = self.client().post('/add-actor',
+                                 json = {'name': "taro", 'age': " 42 ",
+                                         'gender': "Male"},
+                                 headers = casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['age'], 42)
+        self.assertEqual(data['actor']['gender'], "male")
+
+    def test_error_422_invalid_actor_age_and_gender(self):
+        """Test POST and PATCH actors with invalid ages and genders."""
+        for json_actor in ({'name': "taro", 'age': "old", 'gender': "male"},
+                           {'name': "taro", 'age': 200, 'gender': "male"},
+                           {'name': "taro", 'age': 20, 'gender': "robot"}):
+            res = self.client().post('/add-actor',
+                                     json = json_actor,
+                                     headers = casting_director_auth_header)
+            self.assertEqual(res.status_code, 422)
+
+        actor = Actor(name="taro", age=20, gender="male")
+        actor.insert()
+        res = self.client().patch(f'/actors/{actor.id}',
+                                  json = {'age': -1},
+                                  headers = casting_director_auth_header)
+        self.assertEqual(res.status_code, 422)
+
+#----------------------------------------------------------------------------#
+# Tests for /actors and /movies filtering and sorting
+#----------------------------------------------------------------------------#
+
+    def test_actors_are_filtered(self):
+        """Test GET actors by name prefix, age range and gender."""
+        Actor(name="Zqf_hanako", age=35, gender="female").insert()
+        Actor(name="zqf_yoko", age=20, gender="female").insert()
+        Actor(name="zqf_taro", age=40, gender="male").insert()
+        Actor(name="zqfxkumi", age=35, gender="female").insert()
+
+        res = self.client().get(
+            '/actors?name_prefix=ZQF_&min_age=30&max_age=50&gender=female',
+            headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ["Zqf_hanako"])
+
+    def test_movies_are_sorted_across_pages(self):
+        """Test GET movies by descending title, page by page."""
+        for title in ("zqs-b", "zqs-d", "zqs-a", "zqs-c", "zqs-e"):
+            Movie(title=title, release=date(2006, 6, 30)).insert()
+
+        titles = []
+        url = '/movies?title_prefix=zqs-&sort=-title&limit=2'
+        while url:
+            res = self.client().get(url, headers = casting_assistant_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            titles.extend(movie['title'] for movie in data['movies'])
+            url = None
+            if data['next_cursor']:
+                url = ('/movies?title_prefix=zqs-&sort=-title&limit=2'
+                       f"&cursor={data['next_cursor']}")
+
+        self.assertEqual(titles, ["zqs-e", "zqs-d", "zqs-c", "zqs-b", "zqs-a"])
+
+    def test_movies_without_title_are_sorted_last(self):
+        """Test GET movies by title, page by page, with untitled movies."""
+        for title in ("zqn-b", None, "zqn-a", None):
+            movie = Movie(title=title, release=date(1961, 1, 1))
+            movie.insert()
+
+        for sort, expected in (('title', ["zqn-a", "zqn-b", None, None]),
+                               ('-title', [None, None, "zqn-b", "zqn-a"])):
+            titles = []
+            url = f'/movies?released_before=1961-01-01&sort={sort}&limit=1'
+            while url:
+                res = self.client().get(url, headers = casting_assistant_auth_header)
+                data = json.loads(res.data)
+
+                self.assertEqual(res.status_code, 200)
+                titles.extend(movie['title'] for movie in data['movies'])
+                url = None
+                if data['next_cursor']:
+                    url = (f'/movies?released_before=1961-01-01&sort={sort}'
+                           f"&limit=1&cursor={data['next_cursor']}")
+
+            self.assertEqual(titles, expected)
+
+    def test_sorted_pages_are_index_range_scans(self):
+        """Test GET actors by name after a cursor, with an unnamed actor."""
+        for name in ("zqplan-a", "zqplan-b", None):
+            Actor(name=name, age=20, gender="male").insert()
+        res = self.client().get('/actors?sort=name&limit=1',
+                                headers = casting_assistant_auth_header)
+        url = f"/actors?sort=name&limit=2&cursor={json.loads(res.data)['next_cursor']}"
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            if 'FROM actors' in statement and 'ORDER BY' in statement:
+                statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get(url, headers = casting_assistant_auth_header)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        data = json.loads(res.data)
+
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ["zqplan-b", None])
+        # One range of the (name, id) index for the named actors, then one
+        # for the unnamed ones to fill the page.
+        self.assertEqual(len(statements), 2)
+        for statement, parameters in statements:
+            plan = ' '.join(row[3] for row in memory_database.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters))
+            self.assertIn('SEARCH actors USING INDEX ix_actors_name_id', plan)
+            self.assertNotIn('SCAN', plan)
+
+    def test_movies_are_filtered_by_release(self):
+        """Test GET movies released in a date range, sorted by release."""
+        Movie(title="zqr-old", release=date(1990, 1, 1)).insert()
+        Movie(title="zqr-new", release=date(2021, 5, 1)).insert()
+        Movie(title="zqr-mid", release=date(2005, 3, 1)).insert()
+
+        res = self.client().get(
+            '/movies?title_prefix=zqr&released_after=2000-01-01'
+            '&sort=release&fields=title,release&limit=1',
+            headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['title'], "zqr-mid")
+        self.assertEqual(set(data['movies'][0]), {'title', 'release'})
+
+        res = self.client().get(
+            '/movies?title_prefix=zqr&released_after=2000-01-01'
+            f"&sort=release&limit=1&cursor={data['next_cursor']}",
+            headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ["zqr-new"])
+
+    def test_error_422_invalid_filter_or_sort(self):
+        """Test GET actors and movies with invalid filters or sorts."""
+        for url in ('/actors?sort=age', '/actors?min_age=old',
+                    '/actors?gender=robot', '/movies?released_after=today',
+                    '/movies?sort=title&cursor=WzFd'):
+            res = self.client().get(url, headers = casting_assistant_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertFalse(data['success'])
+
+#----------------------------------------------------------------------------#
+# Tests for /search
+#----------------------------------------------------------------------------#
+
+    def test_search_ranks_actors_and_movies(self):
+        """Test GET search results of both types, best matches first."""
+        Movie(title="Zqsearch", release=date(2006, 6, 30)).insert()
+        Actor(name="Taro Zqsearch", age=30, gender="male").insert()
+        Movie(title="The Zqsearchable Story", release=date(2006, 6, 30)).insert()
+
+        res = self.client().get('/search?q=ZQSEARCH',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(
+            [(result['type'], result.get('name') or result.get('title'))
+             for result in data['results']],
+            [('movie', "Zqsearch"), ('actor', "Taro Zqsearch"),
+             ('movie', "The Zqsearchable Story")])
+
+    def test_search_matches_every_word(self):
+        """Test GET search with several words, after a new row is added."""
+        Actor(name="Hanako Zqwords", age=30, gender="female").insert()
+        self.client().get('/search?q=zqwords',
+                          headers = casting_assistant_auth_header)
+        Actor(name="Yoko Zqwords", age=30, gender="female").insert()
+
+        res = self.client().get('/search?q=zqwords+yo',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['name'] for result in data['results']],
+                         ["Yoko Zqwords"])
+
+    def test_error_422_search_without_words(self):
+        """Test GET search without a query."""
+        for url in ('/search', '/search?q=+-!'):
+            res = self.client().get(url, headers = casting_assistant_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertFalse(data['success'])
+
+    def test_error_422_search_with_cursor(self):
+        """Test GET search with a cursor, which search results do not have."""
+        res = self.client().get('/search?q=zqpage&cursor=WzFd',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_search_index_is_replaced_on_rebuild(self):
+        """Test a rebuild leaves the snapshot of a running search intact."""
+        Actor(name="Hanako Zqsnap", age=30, gender="female").insert()
+        index = InvertedIndex()
+        with self.app.app_context():
+            before = index.refresh()
+            Actor(name="Yoko Zqsnap", age=30, gender="female").insert()
+            after = index.refresh()
+
+        self.assertIsNot(before, after)
+        self.assertEqual(len(before.match('zqsnap', prefix=False)), 1)
+        self.assertEqual(len(after.match('zqsnap', prefix=False)), 2)
+        for key in before.match('zqsnap', prefix=False):
+            self.assertIn(key, before.documents)
+
+#----------------------------------------------------------------------------#
+# Tests for movie casts
+#----------------------------------------------------------------------------#
+
+    def count_queries(self, url, headers):
+        """Returns the response to GET `url` and the SQL statements it ran."""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get(url, headers = headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return res, statements
+
+    def test_cast_is_assigned_and_included(self):
+        """Test POST actors to a cast and GET them with include."""
+        movie = Movie(title="zqcast", release=date(2006, 6, 30))
+        movie.insert()
+        movie_id = movie.id
+        actors = [Actor(name=name, age=20, gender="male")
+                  for name in ("ichiro", "jiro")]
+        for actor in actors:
+            actor.insert()
+        actor_ids = [actor.id for actor in actors]
+
+        res = self.client().post(f'/movies/{movie_id}/cast',
+                                 json = {'actor_ids': actor_ids + [987654]},
+                                 headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor_ids'], actor_ids)
+        self.assertEqual(data['not_found'], [987654])
+
+        res = self.client().get(f'/movies/{movie_id}?include=cast',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['movie']['cast']],
+                         ["ichiro", "jiro"])
+
+        res = self.client().get(f'/actors/{actor_ids[0]}?include=movies',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['actor']['movies']],
+                         [movie_id])
+
+    def test_cast_is_unassigned(self):
+        """Test DELETE an actor from a cast, and a deleted actor leaving it."""
+        movie = Movie(title="zqcast", release=date(2006, 6, 30))
+        movie.insert()
+        movie_id = movie.id
+        actors = [Actor(name=name, age=20, gender="male")
+                  for name in ("ichiro", "jiro")]
+        for actor in actors:
+            actor.insert()
+        actor_ids = [actor.id for actor in actors]
+        self.client().post(f'/movies/{movie_id}/cast',
+                           json = {'actor_ids': actor_ids},
+                           headers = executive_producer_auth_header)
+
+        url = f'/movies/{movie_id}/cast/{actor_ids[0]}'
+        res = self.client().delete(url, headers = executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete(url, headers = executive_producer_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+        self.client().delete('/actors/bulk', json = {'ids': actor_ids[1:]},
+                             headers = casting_director_auth_header)
+        res = self.client().get(f'/movies/{movie_id}?include=cast',
+                                headers = casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['cast'], [])
+
+    def test_include_cast_query_count_is_constant(self):
+        """Test GET movies with their cast runs as many queries for any page size."""
+        url = '/movies?title_prefix=zqcount&include=cast&limit=50'
+        counts = []
+        for title in ("zqcount-a", "zqcount-b", "zqcount-c"):
+            movie = Movie(title=title, release=date(2006, 6, 30))
+            movie.insert()
+            actor = Actor(name=title, age=20, gender="female")
+            actor.insert()
+            self.client().post(f'/movies/{movie.id}/cast',
+                               json = {'actor_ids': [actor.id]},
+                               headers = executive_producer_auth_header)
+
+            res, statements = self.count_queries(
+                url, casting_assistant_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(all(len(movie['cast']) == 1
+                                for movie in data['movies']))
+            counts.append(len(statements))
+
+        self.assertEqual(len(data['movies']), 3)
+        self.assertEqual(len(set(counts)), 1)
+
+    def test_error_403_include_cast_with_etag(self):
+        """Test GET movies with their cast and a known ETag, without get:actors."""
+        Movie(title="zqetag", release=date(2006, 6, 30)).insert()
+        url = '/movies?title_prefix=zqetag&include=cast'
+        res = self.client().get(url, headers = casting_assistant_auth_header)
+        etag = res.headers['ETag']
+        movies_only_header = issuer.auth_header(
+            ['get:movies'], subject='local|movies_only')
+
+        for headers in (movies_only_header,
+                        dict(movies_only_header, **{'If-None-Match': etag})):
+            res = self.client().get(url, headers = headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 403)
+            self.assertFalse(data['success'])
+
+    def test_error_404_cast_of_missing_movie(self):
+        """Test POST a cast to a movie that does not exist."""
+        res = self.client().post('/movies/987654/cast',
+                                 json = {'actor_ids': [1]},
+                                 headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+#----------------------------------------------------------------------------#
+# Tests for response compression
+#----------------------------------------------------------------------------#
+
+    def test_large_actors_page_is_gzipped(self):
+        """Test GET actors from a client accepting gzip."""
+        for i in range(3):
+            Actor(name=f"zqgzip {i} " + "x" * 200, age=20,
+                  gender="male").insert()
+        headers = dict(casting_assistant_auth_header,
+                       **{'Accept-Encoding': 'gzip'})
+
+        res = self.client().get('/actors?name_prefix=zqgzip', headers = headers)
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        self.assertEqual(len(data['actors']), 3)
+
+        res = self.client().get('/actors?name_prefix=zqgzip', headers = dict(
+            headers, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_small_error_is_not_compressed(self):
+        """Test GET a missing actor from a client accepting gzip."""
+        res = self.client().get('/actors/987654', headers = dict(
+            casting_assistant_auth_header, **{'Accept-Encoding': 'gzip'}))
+
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_cached_response_is_stored_compressed(self):
+        """Test GET actors twice with gzip: compressed once, then replayed."""
+        cache = FakeCache()
+        init_cache(self.app, cache)
+        for i in range(3):
+            Actor(name=f"zqcached {i} " + "x" * 200, age=20,
+                  gender="male").insert()
+        headers = dict(casting_assistant_auth_header,
+                       **{'Accept-Encoding': 'gzip'})
+
+        with mock.patch('compression.compress', wraps=compression.compress) \
+                as compress:
+            first = self.client().get('/actors?name_prefix=zqcached',
+                                      headers = headers)
+            second = self.client().get('/actors?name_prefix=zqcached',
+                                       headers = headers)
+
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(list(cache.values.values())[0].encoding, 'gzip')
+
+    def test_streamed_export_is_gzipped_per_batch(self):
+        """Test GET actors as a gzipped stream, each batch decodable on arrival."""
+        self.app.config['STREAM_BATCH_SIZE'] = 1
+        for name in ("zqstreamgz-a", "zqstreamgz-b"):
+            Actor(name=name, age=30, gender="female").insert()
+        headers = dict(casting_assistant_auth_header,
+                       **{'Accept-Encoding': 'gzip'})
+
+        res = self.client().get(
+            '/actors?stream=1&format=ndjson&name_prefix=zqstreamgz-',
+            headers = headers, buffered = False)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        lines = []
+        for chunk in res.response:
+            lines.extend(decompressor.decompress(chunk).splitlines())
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual([json.loads(line)['name'] for line in lines],
+                         ["zqstreamgz-a", "zqstreamgz-b"])
+        self.assertTrue(decompressor.eof)
+
+#----------------------------------------------------------------------------#
+# Tests for the ASGI entry point
+#----------------------------------------------------------------------------#
+
+    def call_asgi(self, method, path, query=b'', headers=None, chunks=(b'',)):
+        """Runs one request through the ASGI adapter and returns what it sent."""
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'http_version': '1.1', 'scheme': 'http',
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in (headers or {}).items()]
+        }
+        received = [{'type': 'http.request', 'body': chunk,
+                     'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            if received:
+                return received.pop(0)
+            # Like a server, blocks until the client disconnects.
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(ASGIAdapter(self.app, 2)(scope, receive, send))
+        return sent
+
+    def test_asgi_post_actor(self):
+        """Test POST new actor through ASGI with a body in two parts."""
+        body = json.dumps({'name': "zqasgi", 'age': 30, 'gender': "female"})
+        sent = self.call_asgi(
+            'POST', '/add-actor',
+            headers = dict(casting_director_auth_header,
+                           **{'Content-Type': 'application/json',
+                              'Content-Length': str(len(body))}),
+            chunks = (body[:10].encode(), body[10:].encode()))
+        data = json.loads(b''.join(message.get('body', b'')
+                                   for message in sent[1:]))
+
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(data['actor']['name'], "zqasgi")
+        self.assertFalse(sent[-1].get('more_body', False))
+
+    def test_asgi_streams_actors(self):
+        """Test GET actors as NDJSON through ASGI, in several chunks."""
+        self.app.config['STREAM_BATCH_SIZE'] = 1
+        for name in ("zqasgi-a", "zqasgi-b"):
+            Actor(name=name, age=30, gender="female").insert()
+
+        sent = self.call_asgi('GET', '/actors',
+                              query = b'stream=1&format=ndjson&name_prefix=zqasgi-',
+                              headers = casting_assistant_auth_header)
+        bodies = [message['body'] for message in sent[1:] if message['body']]
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(json.loads(bodies[1])['name'], "zqasgi-b")
+
+    def test_asgi_stream_waits_for_slow_client(self):
+        """Test a streamed response stays a few chunks ahead of a slow client."""
+        produced = []
+        flask_app = Flask(__name__)
+
+        @flask_app.route('/export')
+        def export():
+            def generate():
+                for i in range(50):
+                    produced.append(i)
+                    yield b'x' * 1000
+            return Response(generate())
+
+        sent = []
+        ahead = []
+        received = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if received:
+                return received.pop(0)
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+            ahead.append(len(produced) - len(sent))
+            await asyncio.sleep(0.001)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/export',
+                 'query_string': b'', 'headers': [],
+                 'server': ('testserver', 80)}
+        asyncio.run(ASGIAdapter(flask_app, 1)(scope, receive, send))
+
+        self.assertEqual(len(produced), 50)
+        self.assertLessEqual(max(ahead), MAX_PENDING_CHUNKS + 1)
+
+    def test_asgi_stream_stops_on_disconnect(self):
+        """Test a streamed response stops once the client disconnects."""
+        produced = []
+        flask_app = Flask(__name__)
+
+        @flask_app.route('/export')
+        def export():
+            def generate():
+                for i in range(50):
+                    produced.append(i)
+                    yield b'x' * 1000
+            return Response(generate())
+
+        sent = []
+        gone = None
+
+        async def receive():
+            nonlocal gone
+            if gone is None:
+                gone = asyncio.Event()
+                return {'type': 'http.request', 'body': b''}
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            # Like uvicorn, returns quietly once the client is gone.
+            sent.append(message)
+            if len(sent) == 5:
+                gone.set()
+            await asyncio.sleep(0.001)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/export',
+                 'query_string': b'', 'headers': [],
+                 'server': ('testserver', 80)}
+        asyncio.run(ASGIAdapter(flask_app, 1)(scope, receive, send))
+
+        self.assertLess(len(produced), 5 + MAX_PENDING_CHUNKS + 2)
+        self.assertNotIn({'type': 'http.response.body', 'body': b''}, sent)
+
+    def test_asgi_lifespan_loads_jwks(self):
+        """Test the ASGI startup fetching the JWKS."""
+        received = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        with mock.patch('auth.jwks_cache.refresh', return_value=True) as refresh:
+            asyncio.run(ASGIAdapter(self.app, 1)(
+                {'type': 'lifespan'}, receive, send))
+
+        refresh.assert_called_once_with()
+        self.assertEqual([message['type'] for message in sent],
+                         ['lifespan.startup.complete',
+                          'lifespan.shutdown.complete'])
+
+#----------------------------------------------------------------------------#
+# Tests for /metrics
+#----------------------------------------------------------------------------#
+
+    def test_metrics_record_requests_and_phases(self):
+        """Test GET metrics after GET actors."""
+        Actor(name="zqmetrics", age=20, gender="male").insert()
+        self.client().get('/actors?name_prefix=zqmetrics',
+                          headers = casting_assistant_auth_header)
+
+        res = self.client().get('/metrics', headers = monitoring_auth_header)
+        text = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('agency_http_requests_total{route="/actors",'
+                      'method="GET",status="200"}', text)
+        for phase in ('auth', 'sql', 'serialize'):
+            self.assertIn('agency_http_request_phase_seconds_count{'
+                          f'route="/actors",phase="{phase}"}}', text)
+        self.assertIn('agency_http_request_queries_count{route="/actors"}',
+                      text)
+        self.assertIn('# TYPE agency_token_cache_hits_total counter', text)
+        self.assertIn('agency_token_cache_hits_total ', text)
+        self.assertIn('# TYPE agency_token_cache_size gauge', text)
+        self.assertIn('# TYPE agency_db_pool_wait_seconds_total counter',
+                      text)
+
+    def test_metrics_label_unknown_paths_together(self):
+        """Test GET metrics after GET of a missing path."""
+        self.client().get('/no-such-page/1')
+        self.client().get('/no-such-page/2')
+
+        text = self.client().get(
+            '/metrics', headers = monitoring_auth_header).get_data(as_text=True)
+
+        self.assertIn('route="unmatched"', text)
+        self.assertNotIn('no-such-page', text)
+
+    def test_metrics_need_permission(self):
+        """Test GET metrics without a token and without get:metrics."""
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 401)
+
+        res = self.client().get('/metrics',
+                                headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+#----------------------------------------------------------------------------#
+# Tests for the request profiler
+#----------------------------------------------------------------------------#
+
+    def test_sampled_request_is_profiled_with_its_sql(self):
+        """Test GET actors with every request profiled."""
+        directory = tempfile.mkdtemp()
+        self.app.config.update(PROFILE_SAMPLE_RATE=1, PROFILE_DIR=directory)
+        init_profiler(self.app)
+        Actor(name="zqprofiled", age=20, gender="male").insert()
+
+        res = self.client().get('/actors',
+                                headers = casting_assistant_auth_header)
+        ids = list_profile_ids(directory)
+        with open(os.path.join(directory, ids[0] + '.json')) as profile_file:
+            profile = json.load(profile_file)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(profile['reason'], 'sampled')
+        self.assertEqual(profile['path'], '/actors')
+        self.assertEqual(profile['status'], 200)
+        self.assertTrue(any('actors' in entry['statement']
+                            for entry in profile['statements']))
+
+    def test_profiles_need_permission(self):
+        """Test GET profiles without the get:profiles permission."""
+        app = create_app(dict(TEST_CONFIG, PROFILE_SLOW_SECONDS=60,
+                              PROFILE_INTERVAL=60,
+                              PROFILE_DIR=tempfile.mkdtemp()))
+        res = app.test_client().get('/debug/profiles',
+                                    headers = executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+    def test_profiles_are_not_served_without_profiler(self):
+        """Test GET profiles with the profiler off."""
+        res = self.client().get('/debug/profiles',
+                                headers = executive_producer_auth_header)
+
+        self.assertEqual(res.status_code, 404)
+
+#----------------------------------------------------------------------------#
+# Tests for Idempotency-Key
+#----------------------------------------------------------------------------#
+
+    def test_retried_create_is_replayed(self):
+        """Test POST new actor twice with the same Idempotency-Key."""
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': 'create-zqretry'})
+        json_create_actor = {'name': "zqretry", 'age': 30, 'gender': "female"}
+
+        first = self.client().post('/add-actor', json=json_create_actor,
+                                   headers = headers)
+        second = self.client().post('/add-actor', json=json_create_actor,
+                                    headers = headers)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(Actor.query.filter_by(name="zqretry").count(), 1)
+
+    def test_retried_delete_of_missing_actor_is_replayed(self):
+        """Test DELETE missing actor twice with the same Idempotency-Key."""
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': 'delete-987654'})
+
+        first = self.client().delete('/actors/987654', headers = headers)
+        second = self.client().delete('/actors/987654', headers = headers)
+
+        self.assertEqual(first.status_code, 404)
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(second.status_code, 404)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data, first.data)
+        self.assertFalse(json.loads(second.data)['success'])
+
+    def test_retried_ndjson_bulk_create_is_replayed(self):
+        """Test POST many actors as NDJSON twice with the same Idempotency-Key."""
+        body = '\n'.join(json.dumps({'name': name, 'age': 30, 'gender': "male"})
+                         for name in ("zqndkey-a", "zqndkey-b"))
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': 'bulk-zqndkey'})
+
+        responses = [self.client().post('/actors/bulk', data = body,
+                                        content_type = 'application/x-ndjson',
+                                        headers = headers)
+                     for attempt in range(2)]
+        data = json.loads(responses[0].data)
+
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(len(data['actor_ids']), 2)
+        self.assertEqual(responses[1].headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(
+            Actor.query.filter(Actor.name.like('zqndkey-%')).count(), 2)
+
+    def test_error_422_idempotency_key_reused(self):
+        """Test POST two different actors with the same Idempotency-Key."""
+        headers = dict(casting_director_auth_header,
+                       **{'Idempotency-Key': 'create-zqreused'})
+
+        self.client().post('/add-actor', headers = headers, json={
+            'name': "zqreused", 'age': 30, 'gender': "female"})
+        res = self.client().post('/add-actor', headers = headers, json={
+            'name': "zqreused", 'age': 31, 'gender': "female"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(Actor.query.filter_by(name="zqreused").count(), 1)
+
+    def test_error_409_idempotent_request_in_progress(self):
+        """Test DELETE actor while a request with its key still runs."""
+        actor = Actor(name="zqinflight", age=30, gender="female")
+        actor.insert()
+        actor_id = actor.id
+        store = MemoryIdempotencyStore()
+        init_idempotency(self.app, store)
+        with self.app.test_request_context(
+                f'/actors/{actor_id}', method='DELETE'):
+            store.reserve('local|casting_director|delete-zqinflight',
+                          request_fingerprint())
+
+        res = self.client().delete(f'/actors/{actor_id}', headers = dict(
+            casting_director_auth_header,
+            **{'Idempotency-Key': 'delete-zqinflight'}))
+
+        self.assertEqual(res.status_code, 409)
+        self.assertIsNotNone(Actor.query.get(actor_id))
+
+#----------------------------------------------------------------------------#
+# Tests for If-Match
+#----------------------------------------------------------------------------#
+
+    def test_edit_actor_with_current_version(self):
+        """Test PATCH an actor with the ETag of its GET response."""
+        actor = Actor(name="taro", age=13, gender="male")
+        actor.insert()
+
+        res = self.client().get(f'/actors/{actor.id}',
+                                headers = casting_assistant_auth_header)
+        etag = res.headers['ETag']
+        self.assertEqual(etag, '"1"')
+
+        res = self.client().patch(f'/actors/{actor.id}',
+                                  json = {'age': 14},
+                                  headers = dict(casting_director_auth_header,
+                                                 **{'If-Match': etag}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"2"')
+        self.assertEqual(data['actor']['age'], 14)
+        self.assertEqual(data['actor']['version'], 2)
+
+        res = self.client().get(f'/actors/{actor.id}', headers = dict(
+            casting_assistant_auth_header, **{'If-None-Match': '"2"'}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_error_412_edit_movie_with_stale_version(self):
+        """Test PATCH a movie that was updated since it was read."""
+        movie = Movie(title="kimetu", release=date(2006, 6, 30))
+        movie.insert()
+
+        res = self.client().patch(f'/movies/{movie.id}',
+                                  json = {'title': "kimetu no yaiba"},
+                                  headers = executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().patch(f'/movies/{movie.id}',
+                                  json = {'title': "yaiba"},
+                                  headers = dict(executive_producer_auth_header,
+                                                 **{'If-Match': '"1"'}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertFalse(data['success'])
+        movie = Movie.query.get(movie.id)
+        self.assertEqual(movie.title, "kimetu no yaiba")
+        self.assertEqual(movie.version, 2)
+
+        res = self.client().patch('/movies/123412',
+                                  json = {'title': "yaiba"},
+                                  headers = dict(executive_producer_auth_header,
+                                                 **{'If-Match': '"1"'}))
+        self.assertEqual(res.status_code, 404)
+
+    def test_replayed_edit_keeps_etag(self):
+        """Test PATCH an actor twice with the same Idempotency-Key."""
+        actor = Actor(name="taro", age=13, gender="male")
+        actor.insert()
+        headers = dict(casting_director_auth_header,
+                       **{'If-Match': '"1"', 'Idempotency-Key': 'edit-zqetag'})
+
+        first = self.client().patch(f'/actors/{actor.id}', json = {'age': 14},
+                                    headers = headers)
+        second = self.client().patch(f'/actors/{actor.id}', json = {'age': 14},
+                                     headers = headers)
+
+        self.assertEqual(first.headers['ETag'], '"2"')
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.headers['ETag'], '"2"')
+        self.assertEqual(second.mimetype, 'application/json')
+        self.assertEqual(second.data, first.data)
+
+    def test_bulk_edit_increments_versions(self):
+        """Test PATCH an actor with its version from before a bulk update."""
+        actor = Actor(name="ichiro", age=20, gender="male")
+        actor.insert()
+
+        self.client().patch('/actors/bulk',
+                            json = {'ids': [actor.id], 'changes': {'age': 40}},
+                            headers = casting_director_auth_header)
+
+        self.assertEqual(Actor.query.get(actor.id).version, 2)
+        res = self.client().patch(f'/actors/{actor.id}',
+                                  json = {'age': 41},
+                                  headers = dict(casting_director_auth_header,
+                                                 **{'If-Match': '"1"'}))
+        self.assertEqual(res.status_code, 412)
+
+
+#----------------------------------------------------------------------------#
+# Tests for the JWKS cache
+#----------------------------------------------------------------------------#
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        """Write a local JWKS file and count fetches of it."""
+        jwks = {'keys': [{
+            'kty': 'RSA', 'kid': 'local-key', 'use': 'sig',
+            'n': 'sXch', 'e': 'AQAB'
+        }]}
+        fd, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as jwks_file:
+            json.dump(jwks, jwks_file)
+        self.jwks_url = 'file://' + self.jwks_path
+        self.fetches = 0
+
+    def tearDown(self):
+        os.remove(self.jwks_path)
+
+    def fetch(self, url):
+        self.fetches += 1
+        return get_json_data(url)
+
+    def test_keys_are_served_from_memory_within_ttl(self):
+        cache = JWKSCache(self.jwks_url, ttl=600, fetch=self.fetch)
+
+        self.assertEqual(cache.get('local-key')['kid'], 'local-key')
+        self.assertEqual(cache.get('local-key')['kid'], 'local-key')
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache(self.jwks_url, ttl=600,
+                          min_refetch_interval=0.05, fetch=self.fetch)
+        cache.get('local-key')
+
+        self.assertIsNone(cache.get('rotated-key'))
+        self.assertEqual(self.fetches, 1)
+
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('rotated-key'))
+        self.assertIsNone(cache.get('rotated-key'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_stale_keys_are_served_while_refreshing(self):
+        cache = JWKSCache(self.jwks_url, ttl=0,
+                          min_refetch_interval=0, fetch=self.fetch)
+        cache.get('local-key')
+
+        self.assertEqual(cache.get('local-key')['kid'], 'local-key')
+        for _ in range(100):
+            if self.fetches == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.fetches, 2)
+
+
+#----------------------------------------------------------------------------#
+# Tests for the verified token cache
+#----------------------------------------------------------------------------#
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def test_payload_is_cached_until_exp(self):
+        cache = TokenCache(maxsize=10, leeway=0)
+        cache.put('fresh', compile_payload({'exp': time.time() + 60}))
+        cache.put('expired', compile_payload({'exp': time.time() - 1}))
+
+        self.assertIsNotNone(cache.get('fresh'))
+        self.assertIsNone(cache.get('expired'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_clock_skew_is_allowed(self):
+        cache = TokenCache(maxsize=10, leeway=30)
+        cache.put('token', compile_payload({'exp': time.time() - 1}))
+
+        self.assertIsNotNone(cache.get('token'))
+
+    def test_least_recently_used_token_is_evicted(self):
+        cache = TokenCache(maxsize=2, leeway=0)
+        verified = compile_payload({'exp': time.time() + 60})
+        cache.put('a', verified)
+        cache.put('b', verified)
+        cache.get('a')
+        cache.put('c', verified)
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_token_is_verified_once(self):
+        payload = {'exp': time.time() + 60, 'permissions': []}
+        with mock.patch('auth.token_cache', TokenCache()), \
+                mock.patch('auth.verify_decode_jwt',
+                           return_value=payload) as verify:
+            get_verified_token('token')
+            verified = get_verified_token('token')
+
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(verified.permissions, frozenset())
+
+    def test_permissions_all_of_and_any_of(self):
+        verified = compile_payload({'permissions': ['get:actors']})
+        required = frozenset(['get:actors', 'get:movies'])
+
+        self.assertTrue(check_permissions(required, verified, ANY_OF))
+        with self.assertRaises(AuthError) as error:
+            check_permissions(required, verified)
+        self.assertEqual(error.exception.status_code, 403)
+
+    def test_payload_without_permissions_is_invalid(self):
+        with self.assertRaises(AuthError) as error:
+            check_permissions('get:actors', {'sub': 'user'})
+        self.assertEqual(error.exception.status_code, 422)
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the response cache backends
+#----------------------------------------------------------------------------#
+
+class FakeCache(CacheBackend):
+    """Dictionary backed response cache recording its calls"""
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.invalidated = []
+
+    def get(self, key):
+        value = self.values.get(key)
+        if value is not None:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, tags=()):
+        self.values[key] = value
+
+    def invalidate(self, tag):
+        self.invalidated.append(tag)
+        self.values.clear()
+
+    def stats(self):
+        return {'size': len(self.values), 'hits': self.hits}
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """This class represents the LRU response cache test case"""
+
+    def response(self, body):
+        return CachedResponse(body, 200, 'application/json', 'etag')
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', self.response(b'aa'), ['actors'])
+        cache.set('b', self.response(b'bb'), ['movies'])
+        cache.get('a')
+        cache.set('c', self.response(b'cc'), ['movies'])
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertEqual(cache.stats()['bytes'], 4)
+        self.assertEqual(cache.stats()['hit_ratio'], 2 / 3)
+
+    def test_invalidate_drops_only_tagged_entries(self):
+        cache = LRUCache(maxsize=10)
+        cache.set('a', self.response(b'aa'), ['actors'])
+        cache.set('m', self.response(b'mm'), ['movies'])
+        cache.invalidate('actors')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('m'))
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the connection pool
+#----------------------------------------------------------------------------#
+
+class PoolTestCase(unittest.TestCase):
+    """This class represents the connection pool test case"""
+
+    def test_engine_options_follow_config(self):
+        config = {
+            'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 1, 'DB_POOL_RECYCLE': 60,
+            'DB_POOL_TIMEOUT': 2, 'DB_POOL_PRE_PING': True
+        }
+
+        options = engine_options(config, 'postgresql://localhost/henana')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 1)
+        self.assertTrue(options['pool_pre_ping'])
+
+        options = engine_options(config, 'sqlite://')
+        self.assertNotIn('pool_size', options)
+
+    def test_checkout_waits_are_recorded(self):
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.01)
+        checkouts = pool_metrics.checkouts
+        timeouts = pool_metrics.timeouts
+
+        connection = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        connection.close()
+
+        self.assertEqual(pool_metrics.checkouts, checkouts + 2)
+        self.assertEqual(pool_metrics.timeouts, timeouts + 1)
+        self.assertTrue(pool_metrics.wait_seconds_max >= 0.01)
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the app startup
+#----------------------------------------------------------------------------#
+
+class StartupTestCase(unittest.TestCase):
+    """This class represents the app startup test case"""
+
+    # Seconds "import app" may take in a fresh interpreter.
+    import_budget = float(os.environ.get('IMPORT_BUDGET_SECONDS', 2))
+
+    def test_import_is_fast_and_needs_no_database(self):
+        env = dict(os.environ,
+                   DATABASE_URL='postgresql://agency@127.0.0.1:1/unreachable')
+        script = ('import time; start = time.perf_counter(); import app; '
+                  'print(time.perf_counter() - start)')
+
+        result = subprocess.run(
+            [sys.executable, '-c', script], env=env, capture_output=True,
+            text=True, timeout=60,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertLess(float(result.stdout), self.import_budget)
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the JSON serializers
+#----------------------------------------------------------------------------#
+
+
+class SerializationTestCase(unittest.TestCase):
+    """This class represents the JSON serializer test case"""
+
+    data = {'success': True, 'movies': [
+        {'id': 1, 'title': "Amélie", 'release': date(2001, 4, 25)}]}
+
+    def test_serializers_agree(self):
+        encoded = [json.loads(dumps(self.data))
+                   for dumps in SERIALIZERS.values()
+                   if dumps is not dumps_orjson or orjson is not None]
+
+        self.assertEqual(encoded[0]['movies'][0]['release'], "2001-04-25")
+        self.assertTrue(all(value == encoded[0] for value in encoded))
+
+    def test_unknown_serializer_is_rejected(self):
+        app = mock.Mock(config={'JSON_SERIALIZER': 'yaml'})
+
+        with self.assertRaises(ValueError):
+            init_serializer(app)
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the metric types
+#----------------------------------------------------------------------------#
+
+class MetricsTestCase(unittest.TestCase):
+    """This class represents the metric types test case"""
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram('test_seconds', 'Test.', ('route',), (0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe(('/a"b',), value)
+
+        lines = list(histogram.render())
+
+        self.assertEqual(lines, [
+            'agency_test_seconds_bucket{route="/a\\"b",le="0.1"} 1',
+            'agency_test_seconds_bucket{route="/a\\"b",le="1"} 3',
+            'agency_test_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+            'agency_test_seconds_sum{route="/a\\"b"} 4.05',
+            'agency_test_seconds_count{route="/a\\"b"} 4'
+        ])
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the request profiler
+#----------------------------------------------------------------------------#
+
+class ProfilerTestCase(unittest.TestCase):
+    """This class represents the request profiler test case"""
+
+    def test_slow_request_is_sampled_once_past_threshold(self):
+        profiler = Profiler(tempfile.mkdtemp(), slow_seconds=0.01)
+
+        profile = profiler.start()
+        profiler.sample()
+        self.assertEqual(profile.samples, 0)
+        time.sleep(0.02)
+        profiler.sample()
+        profile_id = profiler.finish(profile, {'path': '/movies'})
+
+        self.assertEqual(profile.samples, 1)
+        self.assertIsNotNone(profile_id)
+        self.assertIsNone(profiler.finish(profiler.start(), {}))
+
+    def test_ring_buffer_keeps_newest_profiles(self):
+        directory = tempfile.mkdtemp()
+        profiler = Profiler(directory, sample_rate=1, max_files=2)
+
+        ids = [profiler.write({'path': f'/actors/{i}'}) for i in range(3)]
+
+        self.assertEqual(list_profile_ids(directory), ids[:0:-1])
+
+
+
+#----------------------------------------------------------------------------#
+# Tests for the idempotency key store
+#----------------------------------------------------------------------------#
+
+class IdempotencyStoreTestCase(unittest.TestCase):
+    """This class represents the idempotency key store test case"""
+
+    def test_keys_expire_after_ttl(self):
+        store = MemoryIdempotencyStore(ttl=0.01)
+        response = StoredResponse(
+            b'{}', 200, [('Content-Type', 'application/json')])
+
+        self.assertIsNone(store.reserve('key', 'a'))
+        store.complete('key', response)
+        self.assertEqual(store.reserve('key', 'a').response, response)
+        time.sleep(0.02)
+
+        self.assertIsNone(store.reserve('key', 'b'))
+        self.assertEqual(store.stats(), {'size': 1, 'replays': 1})
+
+    def test_released_key_can_be_reserved_again(self):
+        store = MemoryIdempotencyStore()
+
+        store.reserve('key', 'a')
+        store.release('key')
+
+        self.assertIsNone(store.reserve('key', 'a'))
+
+
 
 if __name__ == "__main__":
     unittest.main()